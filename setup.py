@@ -22,6 +22,12 @@ setup(
         ],
         'dev': [
             'ipdb',
+        ],
+        'fast': [
+            'orjson==3.8.3',
+        ],
+        'parquet': [
+            'pyarrow==12.0.1',
         ]
     },
     entry_points="""
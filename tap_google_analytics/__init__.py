@@ -1,5 +1,9 @@
+import argparse
 import functools
 import itertools
+import json
+import sys
+import threading
 from datetime import timedelta
 
 import singer
@@ -7,6 +11,9 @@ from singer import utils, get_bookmark, metadata
 from singer.catalog import write_catalog, Catalog
 from .client import Client
 from .discover import discover
+from .sharding import sync_reports_in_processes
+from .output import MessageOutput, OutputCancelledError, SingerOutput, get_output
+from .state import expand_state
 from .sync import sync_report
 
 LOGGER = singer.get_logger()
@@ -27,7 +34,6 @@ def clean_state_for_report(config, state, tap_stream_id):
                                           view_id,
                                           {'last_report_date': top_level_bookmark.strftime("%Y-%m-%d")})
         state = singer.clear_bookmark(state, tap_stream_id, 'last_report_date')
-        singer.write_state(state)
     return state
 
 def get_start_date(config, view_id, state, tap_stream_id):
@@ -57,35 +63,52 @@ def get_end_date(config):
 def get_view_ids(config):
     return config.get('view_ids') or [config.get('view_id')]
 
-def do_sync(client, config, catalog, state):
+def get_selected_fields(stream):
+    """
+    Returns the lists of metrics and dimensions selected in the stream's
+    metadata.
+    """
+    metrics = []
+    dimensions = []
+    mdata = metadata.to_map(stream.metadata)
+    for field_path, field_mdata in mdata.items():
+        if field_path == tuple():
+            continue
+        if field_mdata.get('inclusion') == 'unsupported':
+            continue
+        _, field_name = field_path
+        if field_mdata.get('inclusion') == 'automatic' or \
+           field_mdata.get('selected') or \
+           (field_mdata.get('selected-by-default') and field_mdata.get('selected') is None):
+            if field_mdata.get('behavior') == 'METRIC':
+                metrics.append(field_name)
+            elif field_mdata.get('behavior') == 'DIMENSION':
+                dimensions.append(field_name)
+    return metrics, dimensions
+
+def do_sync(client, config, catalog, state, output=None):
     """
     Translate metadata into a set of metrics and dimensions and call out
     to sync to generate the required reports.
     """
+    output = output or SingerOutput()
+    try:
+        _sync_streams(client, config, catalog, state, output)
+    finally:
+        output.flush()
+
+def _sync_streams(client, config, catalog, state, output):
+    # NB: State written in the compact layout is synced from one bookmark per view
+    state = expand_state(state)
     selected_streams = catalog.get_selected_streams(state)
     for stream in selected_streams:
         # Transform state for this report to new format before proceeding
         state = clean_state_for_report(config, state, stream.tap_stream_id)
 
         state = singer.set_currently_syncing(state, stream.tap_stream_id)
-        singer.write_state(state)
-
-        metrics = []
-        dimensions = []
-        mdata = metadata.to_map(stream.metadata)
-        for field_path, field_mdata in mdata.items():
-            if field_path == tuple():
-                continue
-            if field_mdata.get('inclusion') == 'unsupported':
-                continue
-            _, field_name = field_path
-            if field_mdata.get('inclusion') == 'automatic' or \
-               field_mdata.get('selected') or \
-               (field_mdata.get('selected-by-default') and field_mdata.get('selected') is None):
-                if field_mdata.get('behavior') == 'METRIC':
-                    metrics.append(field_name)
-                elif field_mdata.get('behavior') == 'DIMENSION':
-                    dimensions.append(field_name)
+        output.write_state(state)
+
+        metrics, dimensions = get_selected_fields(stream)
 
         view_ids = get_view_ids(config)
 
@@ -110,23 +133,188 @@ def do_sync(client, config, catalog, state):
 
         schema = stream.schema.to_dict()
 
-        singer.write_schema(
+        output.write_schema(
             stream.stream,
             schema,
             stream.key_properties
             )
 
-        for report in reports_per_view:
-            state['currently_syncing_view'] = report['profile_id']
-            singer.write_state(state)
+        sync_processes = int(config.get("sync_processes") or 0)
+        if sync_processes > 1:
+            # NB: Views are synced concurrently, so there is no current view to resume from
+            state.pop('currently_syncing_view', None)
+            reports = [(report, *get_start_date(config, report['profile_id'], state, report['id']))
+                       for report in reports_per_view]
+            state = sync_reports_in_processes(config, schema, reports, end_date, state, output, sync_processes)
+        else:
+            for report in reports_per_view:
+                state['currently_syncing_view'] = report['profile_id']
+                output.write_state(state)
 
-            is_historical_sync, start_date = get_start_date(config, report['profile_id'], state, report['id'])
+                is_historical_sync, start_date = get_start_date(config, report['profile_id'], state, report['id'])
 
-            sync_report(client, schema, report, start_date, end_date, state, is_historical_sync)
+                sync_report(client, schema, report, start_date, end_date, state, is_historical_sync, output, config)
         state.pop('currently_syncing_view', None)
-        singer.write_state(state)
+        output.write_state(state)
+    state = singer.set_currently_syncing(state, None)
+    output.write_state(state)
+
+# Pages of records (or state messages) held for an in-process consumer
+DEFAULT_MAX_QUEUED_MESSAGES = 10
+
+def sync_messages(client, config, catalog, state, max_queued=DEFAULT_MAX_QUEUED_MESSAGES):
+    """
+    Runs `do_sync` on a background thread and yields its output as
+    singer-python `SchemaMessage`, `RecordMessage` and `StateMessage`
+    objects, for embedding the tap in a Python process without JSON.
+
+    Records are the transformed dicts, and each `StateMessage` holds a
+    snapshot of state that is safe to persist once the records before it
+    have been processed. Exceptions from the sync are raised from the
+    iterator. Stopping iteration early cancels the sync.
+    """
+    output = MessageOutput(max_queued)
+
+    def run_sync():
+        try:
+            do_sync(client, config, catalog, state, output)
+        except OutputCancelledError:
+            pass
+        except Exception as ex: # pylint: disable=broad-except
+            output.finish(ex)
+        else:
+            output.finish()
+
+    thread = threading.Thread(target=run_sync, name="tap-google-analytics-sync", daemon=True)
+    thread.start()
+    try:
+        yield from output.messages()
+    finally:
+        output.cancel()
+
+# Days of a view's report covered by each work unit of a plan
+DEFAULT_PLAN_WINDOW_DAYS = 30
+
+def plan_work_units(config, catalog, state):
+    """
+    Splits a sync into independent work units, one per selected stream,
+    view and window of `plan_window_days` days, from the view's bookmark
+    (or `start_date`) to the end date.
+
+    `estimated_requests` is a lower bound of one request per day.
+    `estimated_cost` also weighs in the dimensions, since more dimensions
+    mean more rows, and so more pages.
+    """
+    window_days = int(config.get("plan_window_days") or DEFAULT_PLAN_WINDOW_DAYS)
+    end_date = get_end_date(config)
+    state = expand_state(state)
+    units = []
+    for stream in catalog.get_selected_streams(state):
+        state = clean_state_for_report(config, state, stream.tap_stream_id)
+        _, dimensions = get_selected_fields(stream)
+        for view_id in get_view_ids(config):
+            is_historical_sync, window_start = get_start_date(config, view_id, state, stream.tap_stream_id)
+            while window_start <= end_date:
+                window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+                days = (window_end - window_start).days + 1
+                units.append({"id": "{}/{}/{}".format(stream.tap_stream_id, view_id, window_start.strftime("%Y-%m-%d")),
+                              "tap_stream_id": stream.tap_stream_id,
+                              "view_id": view_id,
+                              "start_date": window_start.strftime("%Y-%m-%d"),
+                              "end_date": window_end.strftime("%Y-%m-%d"),
+                              "is_historical_sync": is_historical_sync,
+                              "estimated_requests": days,
+                              "estimated_cost": days * (1 + len(dimensions))})
+                window_start = window_end + timedelta(days=1)
+    return units
+
+def run_work_unit(client, config, catalog, work_unit, output):
+    """
+    Syncs exactly one work unit from `plan_work_units`.
+
+    The unit's state carries the unit itself under `work_unit`, so
+    `merge_work_unit_states` can fold its bookmark back into the
+    canonical state. The last state written marks the unit `complete`
+    and records how bookmarking ended.
+    """
+    stream = catalog.get_stream(work_unit["tap_stream_id"])
+    metrics, dimensions = get_selected_fields(stream)
+    report = {"profile_id": work_unit["view_id"],
+              "name": stream.stream,
+              "id": stream.tap_stream_id,
+              "metrics": metrics,
+              "dimensions": dimensions}
+    schema = stream.schema.to_dict()
+    output.write_schema(stream.stream, schema, stream.key_properties)
+
+    state = {"work_unit": dict(work_unit)}
+    bookmarks = sync_report(client,
+                            schema,
+                            report,
+                            utils.strptime_to_utc(work_unit["start_date"]),
+                            utils.strptime_to_utc(work_unit["end_date"]),
+                            state,
+                            work_unit["is_historical_sync"],
+                            output,
+                            config)
+    state["work_unit"].update({"complete": True,
+                               "all_data_golden": bookmarks.all_data_golden,
+                               "historically_syncing": bookmarks.historically_syncing,
+                               "first_day_golden": bookmarks.first_day_golden})
+    output.write_state(state)
+    return state
+
+def merge_work_unit_states(state, work_unit_states):
+    """
+    Folds the final states of work units back into `state`, the state the
+    units were planned from.
+
+    Each view's units are applied in date order, starting from the view's
+    bookmark. A unit's bookmark only counts if the units before it covered
+    their whole window, so a missing, failed or non-golden window stops
+    the view's bookmark where the sequential sync would have stopped it.
+
+    Windows of a view without a bookmark are all synced historically. Once
+    an earlier window has left historical syncing, the sequential sync
+    would stop at a window's first day if it isn't golden, so the
+    window's bookmark doesn't count.
+    """
+    state = expand_state(state)
+    units_per_view = {}
+    for unit_state in map(expand_state, work_unit_states):
+        work_unit = unit_state["work_unit"]
+        units_per_view.setdefault((work_unit["tap_stream_id"], work_unit["view_id"]), []).append(unit_state)
+
+    for (tap_stream_id, view_id), unit_states in units_per_view.items():
+        view_bookmark = get_bookmark(state, tap_stream_id, view_id, default={})
+        # NB: Only a historical sync has no bookmark to start from
+        expected_start_date = view_bookmark.get('last_report_date')
+        historically_syncing = expected_start_date is None
+        for unit_state in sorted(unit_states, key=lambda u: u["work_unit"]["start_date"]):
+            work_unit = unit_state["work_unit"]
+            if expected_start_date is None and not work_unit["is_historical_sync"]:
+                break
+            if expected_start_date is not None and work_unit["start_date"] != expected_start_date:
+                break
+            if work_unit["is_historical_sync"] and not historically_syncing and not work_unit.get("first_day_golden"):
+                break
+            unit_bookmark = get_bookmark(unit_state, tap_stream_id, view_id, default={})
+            if unit_bookmark.get('last_report_date'):
+                view_bookmark = unit_bookmark
+            covered_window = work_unit.get("complete") and (work_unit.get("all_data_golden") or
+                                                            work_unit.get("historically_syncing"))
+            if not covered_window:
+                break
+            historically_syncing = work_unit.get("historically_syncing")
+            end_date = utils.strptime_to_utc(work_unit["end_date"])
+            expected_start_date = (end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+
+        if view_bookmark.get('last_report_date'):
+            state = singer.write_bookmark(state, tap_stream_id, view_id, view_bookmark)
+
     state = singer.set_currently_syncing(state, None)
-    singer.write_state(state)
+    state.pop('currently_syncing_view', None)
+    return state
 
 def do_discover(client, config):
     """
@@ -141,19 +329,87 @@ def validate_config_view_ids(config):
     if 'view_id' in config and 'view_ids' in config:
         raise Exception("Config Validation Error: config.json must ONLY contain view_id or view_ids, but not both.")
 
-@utils.handle_top_exception(LOGGER)
-def main():
-    required_config_keys = ['start_date']
-    args = singer.parse_args(required_config_keys)
-    validate_config_view_ids(args.config)
-    if "refresh_token" in args.config:  # if refresh_token in config assume OAuth2 credentials
-        args.config['auth_method'] = "oauth2"
+def validate_config(config):
+    """
+    Validates `config` and sets its `auth_method`, as required by `Client`.
+    """
+    singer.utils.check_config(config, ['start_date'])
+    validate_config_view_ids(config)
+    if "refresh_token" in config:  # if refresh_token in config assume OAuth2 credentials
+        config['auth_method'] = "oauth2"
         additional_config_keys = ['client_id', 'client_secret', 'refresh_token']
     else:  # otherwise, assume Service Account details should be present
-        args.config['auth_method'] = "service_account"
+        config['auth_method'] = "service_account"
         additional_config_keys = ['client_email', 'private_key']
 
-    singer.utils.check_config(args.config, additional_config_keys)
+    singer.utils.check_config(config, additional_config_keys)
+
+def parse_work_unit_args(argv):
+    """
+    Parses the arguments of the work unit subcommands:
+
+    - plan --config CONFIG --catalog CATALOG [--state STATE]
+      Writes the work units of a sync to stdout as JSON.
+    - run-unit --config CONFIG --catalog CATALOG --unit UNIT
+      Syncs the work unit in the UNIT JSON file, as a regular sync would.
+    - merge-state [--state STATE] UNIT_STATE [UNIT_STATE ...]
+      Writes STATE with the final states of work units folded in to stdout.
+    """
+    parser = argparse.ArgumentParser(prog="tap-google-analytics")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan")
+    plan_parser.add_argument("--config", required=True)
+    plan_parser.add_argument("--catalog", required=True)
+    plan_parser.add_argument("--state")
+
+    run_unit_parser = subparsers.add_parser("run-unit")
+    run_unit_parser.add_argument("--config", required=True)
+    run_unit_parser.add_argument("--catalog", required=True)
+    run_unit_parser.add_argument("--unit", required=True)
+
+    merge_state_parser = subparsers.add_parser("merge-state")
+    merge_state_parser.add_argument("--state")
+    merge_state_parser.add_argument("unit_states", nargs="+")
+
+    return parser.parse_args(argv)
+
+def main_work_units(argv):
+    args = parse_work_unit_args(argv)
+    state = utils.load_json(args.state) if args.state else {}
+
+    if args.command == "merge-state":
+        work_unit_states = [utils.load_json(path) for path in args.unit_states]
+        json.dump(merge_work_unit_states(state, work_unit_states), sys.stdout, indent=2)
+        return
+
+    config = utils.load_json(args.config)
+    validate_config(config)
+    catalog = Catalog.load(args.catalog)
+
+    if args.command == "plan":
+        json.dump({"units": plan_work_units(config, catalog, state)}, sys.stdout, indent=2)
+        return
+
+    client = Client(config, args.config)
+    output = get_output(config)
+    try:
+        run_work_unit(client, config, catalog, utils.load_json(args.unit), output)
+    finally:
+        output.close()
+
+# Subcommands for distributing a sync as independent work units
+WORK_UNIT_COMMANDS = {"plan", "run-unit", "merge-state"}
+
+@utils.handle_top_exception(LOGGER)
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in WORK_UNIT_COMMANDS:
+        main_work_units(sys.argv[1:])
+        return
+
+    required_config_keys = ['start_date']
+    args = singer.parse_args(required_config_keys)
+    validate_config(args.config)
 
     config = args.config
     client = Client(config, args.config_path)
@@ -166,7 +422,11 @@ def main():
     if args.discover:
         do_discover(client, config)
     else:
-        do_sync(client, config, catalog, state)
+        output = get_output(config)
+        try:
+            do_sync(client, config, catalog, state, output)
+        finally:
+            output.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,105 @@
+from datetime import timedelta
+import gzip
+import json
+import os
+import uuid
+
+import singer
+from singer import utils
+
+LOGGER = singer.get_logger()
+
+def get_archive_directory(archive_dir, report):
+    return os.path.join(archive_dir, report["id"], report["profile_id"])
+
+class ResponseArchive():
+    """
+    Append-only archive of the raw report responses of one sync of a
+    view's report, as gzipped JSON lines under
+    `archive_dir/tap_stream_id/profile_id/`.
+
+    Each response is written with the metadata `Client.get_report`
+    attaches to it and flushed, so an interrupted sync leaves every page
+    written before the failure readable.
+    """
+    def __init__(self, archive_dir, report):
+        directory = get_archive_directory(archive_dir, report)
+        os.makedirs(directory, exist_ok=True)
+        # NB: File names sort in the order the syncs started
+        file_name = "{}-{}.jsonl.gz".format(utils.now().strftime("%Y%m%dT%H%M%S%fZ"), uuid.uuid4().hex[:8])
+        self.path = os.path.join(directory, file_name)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+
+    def write_page(self, raw_report_response):
+        response = dict(raw_report_response, reportDate=raw_report_response["reportDate"].strftime("%Y-%m-%d"))
+        self._file.write(json.dumps(response) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def read_archived_pages(path):
+    """ Yields the responses in the archive file at `path`, up to where it was interrupted, if it was. """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                if not line.endswith("\n"):
+                    break
+                response = json.loads(line)
+                response["reportDate"] = utils.strptime_to_utc(response["reportDate"])
+                yield response
+    except EOFError:
+        LOGGER.warning("Archive %s was not closed, replaying the responses written before its sync stopped.", path)
+
+def _is_same_report(response, report):
+    return (sorted(response["metrics"]) == sorted(report["metrics"]) and
+            sorted(response["dimensions"]) == sorted(report["dimensions"]))
+
+def get_archived_report_pages(archive_dir, report, start_date, end_date):
+    """
+    Replays `report` from `archive_dir`, yielding `(report_date,
+    raw_report_response)` for every page of every day from `start_date`
+    to `end_date`, and `(report_date, None)` once a day is complete, as
+    `get_report_pages` would, without making any requests.
+
+    Each day is replayed from the latest archive that holds all of its
+    pages for the report's fields. Replay stops before the first day no
+    archive holds, so bookmarks never skip over it.
+    """
+    directory = get_archive_directory(archive_dir, report)
+    paths = sorted(os.path.join(directory, file_name)
+                   for file_name in (os.listdir(directory) if os.path.isdir(directory) else [])
+                   if file_name.endswith(".jsonl.gz"))
+
+    # First, find the latest archive holding each whole day, without keeping any pages
+    archived_days = {}
+    for path in paths:
+        first_pages, last_pages = {}, {}
+        for response in read_archived_pages(path):
+            if _is_same_report(response, report) and start_date <= response["reportDate"] <= end_date:
+                first_pages.setdefault(response["reportDate"], response.get("pageToken"))
+                last_pages[response["reportDate"]] = response["reports"][0].get("nextPageToken")
+        for report_date, page_token in first_pages.items():
+            if page_token is None and not last_pages[report_date]:
+                archived_days[report_date] = path
+
+    replayed_days = {}
+    report_date = start_date
+    while report_date <= end_date:
+        if report_date not in archived_days:
+            LOGGER.warning("%s for view_id %s is not archived from %s, only replaying the days before it.",
+                           report["name"], report["profile_id"], report_date.strftime("%Y-%m-%d"))
+            break
+        replayed_days[report_date] = archived_days[report_date]
+        report_date += timedelta(days=1)
+
+    first_replayed_days = {}
+    for report_date, path in sorted(replayed_days.items()):
+        first_replayed_days.setdefault(path, report_date)
+    for path in sorted(first_replayed_days, key=first_replayed_days.get):
+        for response in read_archived_pages(path):
+            report_date = response["reportDate"]
+            if replayed_days.get(report_date) == path and _is_same_report(response, report):
+                yield report_date, response
+                if not response["reports"][0].get("nextPageToken"):
+                    yield report_date, None
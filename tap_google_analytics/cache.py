@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# Compressed bytes of responses to keep before evicting the least recently used
+DEFAULT_MAX_CACHE_SIZE_MB = 1024
+
+# Share of the max size to evict down to, so evictions are rare
+EVICTION_TARGET = 0.9
+
+def is_golden_response(response):
+    return bool(response["reports"][0].get("data", {}).get("isDataGolden"))
+
+class ResponseCache():
+    """
+    Content-addressed cache of raw report responses on disk.
+
+    Responses are stored gzipped under the SHA 256 hash of the request
+    body that returned them, which includes the view, date, metrics,
+    dimensions and page token. Only golden responses are stored, since
+    they don't change once Google marks them golden.
+
+    A file's modification time is its last use. Once the cache holds more
+    than `max_size_mb`, the least recently used responses are evicted
+    until it holds 90% of it.
+    """
+    def __init__(self, path, max_size_mb=DEFAULT_MAX_CACHE_SIZE_MB):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._sizes = {}
+        for directory, _, file_names in os.walk(path):
+            for file_name in file_names:
+                if file_name.endswith(".json.gz"):
+                    file_path = os.path.join(directory, file_name)
+                    self._sizes[file_path] = os.path.getsize(file_path)
+        self._total_size = sum(self._sizes.values())
+
+    @staticmethod
+    def get_key(body):
+        return hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_file_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".json.gz")
+
+    def get(self, body):
+        """ Returns the cached response to the request `body`, or None. """
+        file_path = self._get_file_path(self.get_key(body))
+        try:
+            with gzip.open(file_path, 'rt', encoding='utf-8') as cache_file:
+                response = json.load(cache_file)
+            os.utime(file_path)
+        except FileNotFoundError:
+            return None
+        return response
+
+    def put(self, body, response):
+        """ Stores `response` to the request `body`, if it's golden. """
+        if not is_golden_response(response):
+            return
+        file_path = self._get_file_path(self.get_key(body))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # NB: Responses are written whole, so other processes never read a partial one
+        temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as cache_file:
+            json.dump(response, cache_file)
+        os.replace(temp_path, file_path)
+
+        with self._lock:
+            file_size = os.path.getsize(file_path)
+            self._total_size += file_size - self._sizes.get(file_path, 0)
+            self._sizes[file_path] = file_size
+            if self._total_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        last_used = {}
+        for file_path in list(self._sizes):
+            try:
+                last_used[file_path] = os.path.getmtime(file_path)
+            except FileNotFoundError:
+                # Evicted by another process
+                del self._sizes[file_path]
+
+        self._total_size = sum(self._sizes.values())
+        target_size = self.max_size * EVICTION_TARGET
+        for file_path in sorted(last_used, key=last_used.get):
+            if self._total_size <= target_size:
+                break
+            self._total_size -= self._sizes.pop(file_path)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        LOGGER.info("Evicted least recently used report responses, the cache now holds %s bytes.", self._total_size)
+
+class CachedResponse():
+    """ A GET response served from the `HttpCache` after a 304 Not Modified. """
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class HttpCache():
+    """
+    Disk cache of management and metadata API GET responses, with the
+    `ETag` and `Last-Modified` they were served with, to request them
+    again conditionally.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _get_file_path(self, url, params):
+        key = hashlib.sha256(json.dumps([url, params or {}], sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + ".json.gz")
+
+    def get(self, url, params):
+        """ Returns the cached `{"etag", "last_modified", "text"}` of a GET, or None. """
+        try:
+            with gzip.open(self._get_file_path(url, params), 'rt', encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return None
+
+    def get_conditional_headers(self, cached):
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    def put(self, url, params, response):
+        """ Stores `response`, if it can be requested conditionally. """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        file_path = self._get_file_path(url, params)
+        temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as cache_file:
+            json.dump({"etag": etag, "last_modified": last_modified, "text": response.text}, cache_file)
+        os.replace(temp_path, file_path)
+
+def get_http_cache(config):
+    """ Returns the `HttpCache` in `http_cache_dir`, if configured. """
+    if not config.get("http_cache_dir"):
+        return None
+    return HttpCache(config["http_cache_dir"])
+
+def get_response_cache(config):
+    """ Returns the `ResponseCache` in `response_cache_dir`, if configured. """
+    if not config.get("response_cache_dir"):
+        return None
+    return ResponseCache(config["response_cache_dir"],
+                         float(config.get("response_cache_max_mb") or DEFAULT_MAX_CACHE_SIZE_MB))
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 import json
+import os
 import pkgutil
 import math
+import threading
+import time
 from jwt import (
     JWT,
     jwk_from_pem,
@@ -11,10 +15,26 @@ import singer
 from singer import utils
 import backoff
 
+from .cache import CachedResponse, get_http_cache, get_response_cache
+
 LOGGER = singer.get_logger()
 
 REQUEST_TIMEOUT = 300
 
+# Management API requests allowed per second, per user
+# https://developers.google.com/analytics/devguides/config/mgmt/v3/limits-quotas
+MANAGEMENT_REQUESTS_PER_SECOND = 10
+
+# Items per page of management API collections, the most Google allows
+MANAGEMENT_PAGE_SIZE = 1000
+
+# Snapshot of the metadata API's standard columns, bundled like ga_cubes.json
+FIELD_METADATA_SNAPSHOT = "ga_columns.json"
+FIELD_METADATA_SOURCES = {"api", "snapshot", "snapshot_refresh"}
+FIELD_METADATA_URL = "https://www.googleapis.com/analytics/v3/metadata/ga/columns"
+# Refreshing the snapshot is tried once, so it never holds up the process
+FIELD_METADATA_REFRESH_TIMEOUT = 30
+
 # pylint: disable=missing-class-docstring
 class GoogleAnalyticsClientError(Exception):
     def __init__(self, message=None, response=None):
@@ -178,6 +198,40 @@ def _update_config_file(config, config_path):
         json.dump(config, config_file, indent=2)
 
 
+# Seconds a profile lookup cached in `profile_lookup_cache_path` is used for
+DEFAULT_PROFILE_LOOKUP_CACHE_TTL = 24 * 60 * 60
+
+def read_profile_lookup_cache(cache_path, ttl, view_ids):
+    """
+    Returns the profile lookup and profiles index cached at `cache_path`,
+    if they were built less than `ttl` seconds ago and have all of
+    `view_ids`.
+    """
+    try:
+        with open(cache_path, encoding='utf8') as cache_file:
+            cache = json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    age = (utils.now() - utils.strptime_to_utc(cache["built_at"])).total_seconds()
+    if age >= ttl or not view_ids <= set(cache["profile_lookup"]):
+        return None
+    return cache
+
+def write_profile_lookup_cache(cache_path, profile_lookup, profiles_index):
+    temp_path = "{}.tmp".format(cache_path)
+    with open(temp_path, 'w', encoding='utf8') as cache_file:
+        json.dump({"built_at": utils.strftime(utils.now()),
+                   "profile_lookup": profile_lookup,
+                   "profiles_index": profiles_index},
+                  cache_file)
+    os.replace(temp_path, cache_path)
+
+def write_field_metadata_snapshot(snapshot_path, field_metadata):
+    temp_path = "{}.tmp".format(snapshot_path)
+    with open(temp_path, 'w', encoding='utf8') as snapshot_file:
+        json.dump(field_metadata, snapshot_file, indent=2, sort_keys=True)
+    os.replace(temp_path, snapshot_path)
+
 def is_cached_profile_lookup_valid(config):
     # When cached_profile_lookup is not in config, the cache is invalid
     if "cached_profile_lookup" not in config:
@@ -209,7 +263,7 @@ def raise_for_error(response):
 
 # pylint: disable=too-many-instance-attributes
 class Client():
-    def __init__(self, config, config_path):
+    def __init__(self, config, config_path=None):
         self.auth_method = config['auth_method']
         if self.auth_method == "oauth2":
             self.refresh_token = config["refresh_token"]
@@ -222,8 +276,14 @@ class Client():
         self.__access_token = None
         self.expires_in = 0
         self.last_refreshed = None
+        # Reports may be requested from several threads at once
+        self._token_lock = threading.Lock()
 
         self.request_timeout = config.get("request_timeout", REQUEST_TIMEOUT)
+        # GET requests are spaced out to stay within the management API quota
+        self.get_request_interval = 1 / float(config.get("management_requests_per_second") or MANAGEMENT_REQUESTS_PER_SECOND)
+        self._get_request_lock = threading.Lock()
+        self._next_get_request = 0
         self.quota_user = config.get("quota_user")
         self.user_agent = config.get("user_agent")
 
@@ -231,7 +291,21 @@ class Client():
         if self.user_agent:
             self.session.headers.update({"User-Agent": self.user_agent})
 
+        # Golden report responses are reused from disk, if configured
+        self.response_cache = get_response_cache(config)
+        # As are unchanged GET responses, if configured
+        self.http_cache = get_http_cache(config)
+
+        self.field_metadata_source = config.get("field_metadata_source") or "api"
+        if self.field_metadata_source not in FIELD_METADATA_SOURCES:
+            raise Exception("Config Validation Error: Unknown field_metadata_source: {}".format(self.field_metadata_source))
+        self.field_metadata_snapshot_path = config.get("field_metadata_snapshot_path")
+        if self.field_metadata_source == "snapshot_refresh" and not self.field_metadata_snapshot_path:
+            raise Exception("Config Validation Error: field_metadata_snapshot_path is required when field_metadata_source is snapshot_refresh.")
+
         self.profile_lookup = {}
+        # {account_id: {web_property_id: [profile_id, ...]}} of the account summaries read
+        self.profiles_index = {}
         self._populate_profile_lookup(config, config_path)
 
 
@@ -239,30 +313,63 @@ class Client():
         """
         Get all profiles available and associate them with their web property
         and account IDs to be looked up later during discovery.
+
+        The profile lookup is cached in the `cached_profile_lookup` config
+        value, or in the `profile_lookup_cache_path` file for
+        `profile_lookup_cache_ttl` seconds, if that is configured.
         """
         if is_cached_profile_lookup_valid(config):
             LOGGER.info("Using cached profile_lookup. Will not check Account Summaries API.")
             self.profile_lookup = json.loads(config["cached_profile_lookup"])
             return
 
-        LOGGER.info("Cached profile_lookup does not exist or is invalid. Rebuilding.")
-        account_summaries = self.get_account_summaries_for_token()
         view_ids = set(config.get("view_ids") or [config.get("view_id")])
+        cache_path = config.get("profile_lookup_cache_path")
+        if cache_path:
+            ttl = float(config.get("profile_lookup_cache_ttl") or DEFAULT_PROFILE_LOOKUP_CACHE_TTL)
+            cache = read_profile_lookup_cache(cache_path, ttl, view_ids)
+            if cache is not None:
+                LOGGER.info("Using profile_lookup cached in %s. Will not check Account Summaries API.", cache_path)
+                self.profile_lookup = cache["profile_lookup"]
+                self.profiles_index = cache.get("profiles_index", {})
+                return
+
+        LOGGER.info("Cached profile_lookup does not exist or is invalid. Rebuilding.")
+        account_summaries = self.get_account_summaries_pages(int(config.get("account_summaries_workers") or 1))
         for account in account_summaries:
             for web_property in account.get('webProperties', []):
+                self.profiles_index.setdefault(account['id'], {})[web_property['id']] = [
+                    profile['id'] for profile in web_property.get('profiles', [])]
                 for profile in web_property.get('profiles', []):
                     # Only cache profile ids that are in our chosen view_ids
                     if profile['id'] not in view_ids:
                         continue
                     self.profile_lookup[profile['id']] = {"web_property_id": web_property['id'],
                                                           "account_id": account['id']}
+            if view_ids <= set(self.profile_lookup):
+                LOGGER.info("Found all view_ids, not checking the remaining account summaries.")
+                account_summaries.close()
+                break
+
+        if cache_path:
+            # NB: Only the accounts of the chosen view_ids are needed later on
+            write_profile_lookup_cache(cache_path,
+                                       self.profile_lookup,
+                                       {lookup["account_id"]: self.profiles_index[lookup["account_id"]]
+                                        for lookup in self.profile_lookup.values()})
+            return
 
         # After rebuilding the cache, write it back to config so it can be persisted
         config['cached_profile_lookup'] = json.dumps(self.profile_lookup)
-        _update_config_file(config, config_path)
+        if config_path:
+            _update_config_file(config, config_path)
 
     # Authentication and refresh
     def _ensure_access_token(self):
+        with self._token_lock:
+            self._refresh_access_token_if_expired()
+
+    def _refresh_access_token_if_expired(self):
         if self.last_refreshed is not None and \
            (utils.now() - self.last_refreshed).total_seconds() < self.expires_in:
             return
@@ -312,37 +419,115 @@ class Client():
                           giveup=should_giveup,
                           factor=10,
                           jitter=None)
-    def _make_request(self, method, url, params=None, data=None):
+    def _make_request(self, method, url, params=None, data=None, headers=None):
+        return self._request(method, url, params=params, data=data, headers=headers)
+
+    def _request(self, method, url, params=None, data=None, headers=None, timeout=None):
+        """ Makes one request, without retrying it. """
+        timeout = timeout or self.request_timeout
         params = params or {}
         data = data or {}
 
         self._ensure_access_token()
 
-        headers = {"Authorization" : "Bearer " + self.__access_token}
+        headers = {"Authorization" : "Bearer " + self.__access_token, **(headers or {})}
         if self.quota_user:
             params["quotaUser"] = self.quota_user
 
         if method == 'POST':
-            response = self.session.post(url, headers=headers, params=params, json=data, timeout=self.request_timeout)
+            response = self.session.post(url, headers=headers, params=params, json=data, timeout=timeout)
         else:
-            response = self.session.request(method, url, headers=headers, params=params, timeout=self.request_timeout)
-        if response.status_code != 200:
+            response = self.session.request(method, url, headers=headers, params=params, timeout=timeout)
+        # NB: 304 Not Modified only answers conditional requests
+        if response.status_code not in (200, 304):
             raise_for_error(response)
 
         return response
 
+    def _wait_for_get_request(self):
+        with self._get_request_lock:
+            now = time.monotonic()
+            wait = max(0, self._next_get_request - now)
+            self._next_get_request = max(now, self._next_get_request) + self.get_request_interval
+        if wait:
+            time.sleep(wait)
+
     def get(self, url, params=None):
-        return self._make_request("GET", url, params=params)
+        self._wait_for_get_request()
+        if not self.http_cache:
+            return self._make_request("GET", url, params=params)
+
+        cache_params = dict(params or {})
+        cached = self.http_cache.get(url, cache_params)
+        response = self._make_request("GET", url, params=params,
+                                      headers=self.http_cache.get_conditional_headers(cached))
+        if response.status_code == 304:
+            LOGGER.info("Using cached response, %s is not modified.", url)
+            return CachedResponse(cached["text"])
+        self.http_cache.put(url, cache_params, response)
+        return response
 
     def post(self, url, data=None):
         return self._make_request("POST", url, data=data)
 
     # Discovery requests
 
-    def get_field_metadata(self):
-        metadata_response = self.get("https://www.googleapis.com/analytics/v3/metadata/{reportType}/columns".format(reportType="ga"))
+    def request_field_metadata(self):
+        metadata_response = self.get(FIELD_METADATA_URL)
         return metadata_response.json()
 
+    def get_field_metadata(self):
+        """
+        Returns the standard columns from the metadata API, or from a
+        snapshot of its response if `field_metadata_source` is "snapshot",
+        without any request.
+
+        With "snapshot_refresh", the snapshot is returned right away and
+        requested again in the background, to be written to
+        `field_metadata_snapshot_path` for the next discovery. Without a
+        snapshot yet, it's requested and written first.
+        """
+        if self.field_metadata_source == "api":
+            return self.request_field_metadata()
+
+        field_metadata = self.get_field_metadata_snapshot()
+        if field_metadata is None:
+            if self.field_metadata_source == "snapshot":
+                raise Exception("Config Validation Error: field_metadata_source is snapshot, but no field metadata "
+                                "snapshot was found at field_metadata_snapshot_path or bundled with the tap.")
+            LOGGER.warning("No field metadata snapshot found, requesting the standard fields.")
+            field_metadata = self.request_field_metadata()
+            write_field_metadata_snapshot(self.field_metadata_snapshot_path, field_metadata)
+            return field_metadata
+
+        LOGGER.info("Using field metadata snapshot (etag: %s)", field_metadata.get("etag"))
+        if self.field_metadata_source == "snapshot_refresh":
+            # NB: A daemon thread, so a refresh that's still running never keeps the process alive
+            threading.Thread(target=self.refresh_field_metadata_snapshot,
+                             name="field-metadata-refresh",
+                             daemon=True).start()
+        return field_metadata
+
+    def get_field_metadata_snapshot(self):
+        """ Returns the snapshot at `field_metadata_snapshot_path`, else the bundled one, or None. """
+        if self.field_metadata_snapshot_path and os.path.exists(self.field_metadata_snapshot_path):
+            with open(self.field_metadata_snapshot_path, 'r', encoding='utf8') as snapshot_file:
+                return json.load(snapshot_file)
+        try:
+            return json.loads(pkgutil.get_data(__package__, FIELD_METADATA_SNAPSHOT).decode('utf-8'))
+        except FileNotFoundError:
+            return None
+
+    def refresh_field_metadata_snapshot(self):
+        try:
+            field_metadata = self._request("GET", FIELD_METADATA_URL, timeout=FIELD_METADATA_REFRESH_TIMEOUT).json()
+        except Exception as ex: # pylint: disable=broad-except
+            LOGGER.warning("Could not refresh the field metadata snapshot: %s", ex)
+            return
+        write_field_metadata_snapshot(self.field_metadata_snapshot_path, field_metadata)
+        LOGGER.info("Refreshed field metadata snapshot %s (etag: %s)",
+                    self.field_metadata_snapshot_path, field_metadata.get("etag"))
+
     def get_raw_cubes(self): # pylint: disable=no-self-use
         return json.loads(pkgutil.get_data(__package__, "ga_cubes.json").decode('utf-8'))
 
@@ -351,8 +536,52 @@ class Client():
         Return a list of accountSummaries (full account hierarchy that token
         user has access to) to discover Goals and custom metrics/dimensions.
         """
-        account_summaries_response = self.get('https://www.googleapis.com/analytics/v3/management/accountSummaries')
-        return account_summaries_response.json()['items']
+        return list(self.get_account_summaries_pages())
+
+    def get_account_summaries_pages(self, workers=1):
+        """
+        Yields the accountSummaries of every page, in order, requesting up
+        to `workers` pages at once after the first one. Stop iterating to
+        stop requesting pages.
+        """
+        url = 'https://www.googleapis.com/analytics/v3/management/accountSummaries'
+        def get_page(start_index):
+            return self.get(url, params={"max-results": MANAGEMENT_PAGE_SIZE, "start-index": start_index}).json()
+
+        first_page = get_page(1)
+        items = first_page.get('items', [])
+        yield from items
+        # NB: Pages hold as many items as the first one
+        page_size = len(items)
+        if not page_size:
+            return
+        start_indexes = list(range(1 + page_size, first_page.get('totalResults', 0) + 1, page_size))
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="account-summaries") as executor:
+            for window_start in range(0, len(start_indexes), max(1, workers)):
+                for page in executor.map(get_page, start_indexes[window_start:window_start + max(1, workers)]):
+                    yield from page.get('items', [])
+
+    def get_all_items(self, url):
+        """
+        Yields the `items` of every page of a paginated management API
+        collection, such as a `~all` wildcard one.
+        """
+        start_index = 1
+        while True:
+            response = self.get(url, params={"max-results": MANAGEMENT_PAGE_SIZE, "start-index": start_index}).json()
+            items = response.get('items', [])
+            yield from items
+            if not response.get('nextLink') or not items:
+                break
+            start_index += len(items)
+
+    def get_all_profiles(self):
+        """ Return every profile the token user has access to, in one paginated request. """
+        return list(self.get_all_items('https://www.googleapis.com/analytics/v3/management/accounts/~all/webproperties/~all/profiles'))
+
+    def get_all_goals(self):
+        """ Return the goals of every profile the token user has access to, in one paginated request. """
+        return list(self.get_all_items('https://www.googleapis.com/analytics/v3/management/accounts/~all/webproperties/~all/profiles/~all/goals'))
 
     def get_accounts_for_token(self):
         """ Return a list of account IDs available to hte associated token. """
@@ -369,7 +598,12 @@ class Client():
     def get_profiles_for_property(self, account_id, web_property_id):
         """
         Gets all profiles for property to associate with custom metrics and dimensions.
+
+        Properties from the account summaries read for the profile lookup
+        are answered from `profiles_index`, without a request.
         """
+        if web_property_id in self.profiles_index.get(account_id, {}):
+            return list(self.profiles_index[account_id][web_property_id])
         profiles_url = 'https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties/{webPropertyId}/profiles'
         profiles_response = self.get(profiles_url.format(accountId=account_id,
                                                          webPropertyId=web_property_id))
@@ -431,7 +665,7 @@ class Client():
 
     # Sync Requests w/ Pagination and token refresh
     # Docs for more info: https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet
-    def get_report(self, name, profile_id, report_date, metrics, dimensions):
+    def get_report(self, name, profile_id, report_date, metrics, dimensions, page_token=None):
         """
         Parameters:
         - name - the tap_stream_id of the report being run
@@ -439,11 +673,12 @@ class Client():
         - report_date - the day to retrieve data for, as a Python datetime object, to limit report data
         - metrics - list of metrics, of the form ["ga:metric1", "ga:metric2", ...]
         - dimensions - list of dimensions, of the form ["ga:dim1", "ga:dim2", ...]
+        - page_token - the page to start from, to resume a partially synced day
 
         Returns:
-        - A generator of a sequence of reports w/ associated metadata (metrics/dims/report_date/profile)
+        - A generator of a sequence of reports w/ associated metadata (metrics/dims/report_date/profile/page token)
         """
-        nextPageToken = None
+        nextPageToken = page_token
         # TODO: Optimization, if speed is an issue, up to 5 requests can be placed per HTTP batch
         # - This will require changes to all parsing code to account for multiple report responses coming back
         while True:
@@ -460,15 +695,22 @@ class Client():
                       "dimensions": [{"name": d} for d in dimensions]}]}
             if nextPageToken:
                 body["reportRequests"][0]["pageToken"] = nextPageToken
-            with singer.metrics.http_request_timer(name):
-                report_response = self.post("https://analyticsreporting.googleapis.com/v4/reports:batchGet", body)
-            report = report_response.json()
+            report = self.response_cache.get(body) if self.response_cache else None
+            if report is not None:
+                LOGGER.info("Using cached golden report response.")
+            else:
+                with singer.metrics.http_request_timer(name):
+                    report_response = self.post("https://analyticsreporting.googleapis.com/v4/reports:batchGet", body)
+                report = report_response.json()
+                if self.response_cache:
+                    self.response_cache.put(body, report)
 
             # Assoc in the request data to be used by the caller
             report.update({"profileId": profile_id,
                            "webPropertyId": self.profile_lookup[profile_id]["web_property_id"],
                            "accountId": self.profile_lookup[profile_id]["account_id"],
                            "reportDate": report_date,
+                           "pageToken": nextPageToken,
                            "metrics": metrics,
                            "dimensions": dimensions})
 
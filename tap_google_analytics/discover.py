@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import re
 from functools import reduce
 import singer
@@ -366,12 +367,9 @@ def parse_cube_definitions(client):
     cubes_lookup = generate_cubes_lookup(raw_cubes)
     return all_cubes, cubes_lookup
 
-def get_custom_metrics(client, profile_id):
-    custom_metrics = client.get_custom_metrics_for_profile(profile_id)
+def get_custom_metrics(client, account_id, web_property_id, profiles):
+    custom_metrics = client.get_custom_metrics(account_id, web_property_id)
     metrics_fields = {"id", "name", "kind", "active", "min_value", "max_value"}
-    account_id = client.profile_lookup[profile_id]["account_id"]
-    web_property_id = client.profile_lookup[profile_id]["web_property_id"]
-    profiles = client.get_profiles_for_property(account_id, web_property_id)
     return  [{"account_id": account_id,
               "web_property_id": web_property_id,
               "profiles": profiles,
@@ -381,12 +379,9 @@ def get_custom_metrics(client, profile_id):
               **{k:v for k,v in item.items() if k in metrics_fields}}
              for item in custom_metrics['items']]
 
-def get_custom_dimensions(client, profile_id):
-    custom_dimensions = client.get_custom_dimensions_for_profile(profile_id)
+def get_custom_dimensions(client, account_id, web_property_id, profiles):
+    custom_dimensions = client.get_custom_dimensions(account_id, web_property_id)
     dimensions_fields = {"id", "name", "kind", "active"}
-    account_id = client.profile_lookup[profile_id]["account_id"]
-    web_property_id = client.profile_lookup[profile_id]["web_property_id"]
-    profiles = client.get_profiles_for_property(account_id, web_property_id)
     return [{"dataType": "STRING",
              "account_id": account_id,
              "web_property_id": web_property_id,
@@ -396,12 +391,36 @@ def get_custom_dimensions(client, profile_id):
              **{k:v for k,v in item.items() if k in dimensions_fields}}
             for item in custom_dimensions['items']]
 
-def get_custom_fields(client, profile_id):
+def get_property_custom_fields(client, account_id, web_property_id):
+    """ Custom fields are defined per web property, along with the profiles they are available in. """
+    profiles = client.get_profiles_for_property(account_id, web_property_id)
     custom_metrics_and_dimensions = []
-    custom_metrics_and_dimensions.extend(get_custom_dimensions(client, profile_id))
-    custom_metrics_and_dimensions.extend(get_custom_metrics(client, profile_id))
+    custom_metrics_and_dimensions.extend(get_custom_dimensions(client, account_id, web_property_id, profiles))
+    custom_metrics_and_dimensions.extend(get_custom_metrics(client, account_id, web_property_id, profiles))
     return custom_metrics_and_dimensions
 
+def get_property(client, profile_id):
+    """ Returns the `(account_id, web_property_id)` of a profile. """
+    return (client.profile_lookup[profile_id]["account_id"],
+            client.profile_lookup[profile_id]["web_property_id"])
+
+def get_custom_fields(client, profile_id):
+    return get_property_custom_fields(client, *get_property(client, profile_id))
+
+def get_custom_fields_per_profile(client, profile_ids, workers=1):
+    """
+    Returns `{profile_id: custom_fields}` in the order of `profile_ids`.
+
+    Profiles of the same web property share its custom fields, so they
+    are requested once per property, for up to `workers` properties at
+    once.
+    """
+    properties = list(dict.fromkeys(get_property(client, profile_id) for profile_id in profile_ids))
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="discovery") as executor:
+        property_custom_fields = dict(zip(properties,
+                                          executor.map(lambda p: get_property_custom_fields(client, *p), properties)))
+    return {profile_id: list(property_custom_fields[get_property(client, profile_id)])
+            for profile_id in profile_ids}
 
 def transform_field(field):
     interesting_attributes = {k: v for k, v in field["attributes"].items()
@@ -456,16 +475,73 @@ def generate_catalog(client, report_config, standard_fields, custom_fields, all_
                                             metadata=metadata.to_list(mdata)))
     return Catalog(catalog_entries)
 
+class DiscoveryClient():
+    """
+    Wraps a `Client` for one discovery, so that each profile's goals and
+    each property's profiles are requested once, however many fields
+    and reports need them.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._goals = {}
+        self._profiles = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_goals_for_profile(self, profile_id):
+        if profile_id not in self._goals:
+            self._goals[profile_id] = self.client.get_goals_for_profile(profile_id)
+        return self._goals[profile_id]
+
+    def get_profiles_for_property(self, account_id, web_property_id):
+        if (account_id, web_property_id) not in self._profiles:
+            self._profiles[(account_id, web_property_id)] = self.client.get_profiles_for_property(account_id,
+                                                                                                 web_property_id)
+        return self._profiles[(account_id, web_property_id)]
+
+    def prefetch_goals(self, profile_ids, workers=1):
+        """ Requests the goals of up to `workers` of `profile_ids` at once. """
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="discovery") as executor:
+            list(executor.map(self.get_goals_for_profile, profile_ids))
+
+    def prefetch_all_goals(self, profile_ids):
+        """ Requests the goals of all profiles with one `~all` wildcard request, keeping those of `profile_ids`. """
+        goals = {profile_id: [] for profile_id in profile_ids}
+        for goal in self.client.get_all_goals():
+            if goal["profileId"] in goals:
+                goals[goal["profileId"]].append(goal["id"])
+        self._goals.update(goals)
+
+    def prefetch_all_profiles(self, profile_ids):
+        """ Requests all profiles with one `~all` wildcard request, keeping those of the properties of `profile_ids`. """
+        profiles = {get_property(self.client, profile_id): [] for profile_id in profile_ids}
+        for profile in self.client.get_all_profiles():
+            if (profile["accountId"], profile["webPropertyId"]) in profiles:
+                profiles[(profile["accountId"], profile["webPropertyId"])].append(profile["id"])
+        self._profiles.update(profiles)
+
 def discover(client, config, profile_ids):
     # Draw from spike to discover all the things
     # Get field_infos (standard and custom)
     report_config = config.get("report_definitions") or []
+    workers = int(config.get("discovery_workers") or 1)
+    # NB: In bulk discovery, goals and profiles come from a few `~all`
+    # wildcard requests rather than a request per profile or property
+    bulk_discovery = config.get("bulk_discovery")
+    client = DiscoveryClient(client)
     LOGGER.info("Discovering standard fields...")
     standard_fields = get_standard_fields(client)
     LOGGER.info("Discovering custom fields...")
-    custom_fields = {}
-    for profile_id in profile_ids:
-        custom_fields[profile_id] = get_custom_fields(client, profile_id)
+    if bulk_discovery:
+        client.prefetch_all_profiles(profile_ids)
+    custom_fields = get_custom_fields_per_profile(client, profile_ids, workers)
+    if report_config and any(f['id'] in goal_related_field_ids for f in standard_fields):
+        LOGGER.info("Discovering goals...")
+        if bulk_discovery:
+            client.prefetch_all_goals(profile_ids)
+        else:
+            client.prefetch_goals(profile_ids, workers)
     LOGGER.info("Parsing cube definitions...")
     all_cubes, cubes_lookup = parse_cube_definitions(client)
     LOGGER.info("Generating catalog...")
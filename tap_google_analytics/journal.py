@@ -0,0 +1,138 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+import singer
+
+LOGGER = singer.get_logger()
+
+class WorkJournal():
+    """
+    SQLite journal of the report pages whose records have been written,
+    keyed by stream, view, selected fields, report date and page token.
+
+    A restarted sync skips the pages of golden days that were already
+    written and resumes a partially written golden day from its next page
+    token. Days that aren't golden are always requested again, since
+    their data may change.
+
+    The date each view's report last started syncing from is kept too. A
+    resumed sync never starts before it, since bookmarks only advance, so
+    a sync that does had its state reset and forgets the journaled days.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                                          report_key TEXT NOT NULL,
+                                          report_date TEXT NOT NULL,
+                                          page_token TEXT NOT NULL,
+                                          next_page_token TEXT,
+                                          is_data_golden INTEGER NOT NULL,
+                                          PRIMARY KEY (report_key, report_date, page_token))""")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                                          report_key TEXT NOT NULL PRIMARY KEY,
+                                          start_date TEXT NOT NULL)""")
+
+    @staticmethod
+    def get_report_key(report):
+        """ Identifies a view's report, including its fields, which change what a page contains. """
+        fields = json.dumps([sorted(report["metrics"]), sorted(report["dimensions"])])
+        return "{}/{}/{}".format(report["id"],
+                                 report["profile_id"],
+                                 hashlib.sha1(fields.encode('utf-8')).hexdigest())
+
+    def get_written_pages(self, report, report_date):
+        """
+        Returns `[(page_token, next_page_token, is_data_golden), ...]` for
+        the pages of the day already written, in request order.
+        """
+        with self._lock:
+            rows = self._connection.execute("""SELECT page_token, next_page_token, is_data_golden FROM pages
+                                               WHERE report_key = ? AND report_date = ?
+                                               ORDER BY rowid""",
+                                            (self.get_report_key(report), report_date.strftime("%Y-%m-%d"))).fetchall()
+        return [(page_token or None, next_page_token, bool(is_data_golden))
+                for page_token, next_page_token, is_data_golden in rows]
+
+    def page_written(self, report, report_date, page_token, next_page_token, is_data_golden):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                     (self.get_report_key(report),
+                                      report_date.strftime("%Y-%m-%d"),
+                                      page_token or "",
+                                      next_page_token,
+                                      bool(is_data_golden)))
+
+    def forget_day(self, report, report_date):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM pages WHERE report_key = ? AND report_date = ?",
+                                     (self.get_report_key(report), report_date.strftime("%Y-%m-%d")))
+
+    def start_sync(self, report, start_date):
+        """
+        Prepares the journal for a sync of `report` from `start_date`,
+        forgetting every day if it starts before the last sync did.
+        """
+        report_key = self.get_report_key(report)
+        start_date_string = start_date.strftime("%Y-%m-%d")
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT start_date FROM syncs WHERE report_key = ?", (report_key,)).fetchone()
+            if row and start_date_string < row[0]:
+                LOGGER.info("%s for view_id %s starts before its last sync (%s), forgetting its journaled pages.",
+                            report["name"], report["profile_id"], row[0])
+                self._connection.execute("DELETE FROM pages WHERE report_key = ?", (report_key,))
+            self._connection.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?)", (report_key, start_date_string))
+        self.prune(report, start_date)
+
+    def prune(self, report, start_date):
+        """ Forgets the days before `start_date`, which are covered by the bookmark. """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM pages WHERE report_key = ? AND report_date < ?",
+                                     (self.get_report_key(report), start_date.strftime("%Y-%m-%d")))
+
+    def close(self):
+        self._connection.close()
+
+def journaled_page(raw_report_response):
+    """ Returns whether a response was replayed from the journal rather than requested. """
+    return raw_report_response.get("fromJournal", False)
+
+class JournalClient():
+    """
+    Wraps a `Client` so that `get_report` replays the written pages of
+    golden days from `journal`, without their rows, and only requests the
+    pages after them.
+    """
+    def __init__(self, client, journal, report):
+        self.client = client
+        self.journal = journal
+        self.report = report
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_report(self, name, profile_id, report_date, metrics, dimensions, page_token=None):
+        written_pages = self.journal.get_written_pages(self.report, report_date)
+        if written_pages and not all(is_data_golden for _, _, is_data_golden in written_pages):
+            self.journal.forget_day(self.report, report_date)
+            written_pages = []
+
+        for written_page_token, next_page_token, is_data_golden in written_pages:
+            yield {"reports": [{"columnHeader": {"metricHeader": {"metricHeaderEntries": []}},
+                                "data": {"isDataGolden": is_data_golden},
+                                "nextPageToken": next_page_token}],
+                   "reportDate": report_date,
+                   "pageToken": written_page_token,
+                   "fromJournal": True}
+
+        if written_pages:
+            page_token = written_pages[-1][1]
+            if not page_token:
+                return
+            LOGGER.info("Resuming %s for view_id %s and date %s from the journal (nextPageToken: %s)",
+                        name, profile_id, report_date.strftime("%Y-%m-%d"), page_token)
+        yield from self.client.get_report(name, profile_id, report_date, metrics, dimensions, page_token=page_token)
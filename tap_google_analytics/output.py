@@ -0,0 +1,619 @@
+import copy
+import gzip
+import os
+import pathlib
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import timezone
+
+import simplejson
+import singer
+from singer import utils
+
+from .state import compact_state
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOGGER = singer.get_logger()
+
+# Bytes of encoded messages to hold before writing them to stdout in one call
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+def dumps(obj):
+    """
+    Encode `obj` as compact JSON text, using orjson when it is installed.
+
+    Values orjson can't encode (e.g., Decimal) fall back to simplejson,
+    which is what singer-python itself uses, so the output is unchanged.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # NB: orjson.JSONEncodeError is a subclass of TypeError
+            pass
+    return simplejson.dumps(obj, use_decimal=True, separators=(',', ':'))
+
+class SingerOutput():
+    """
+    Writes SCHEMA, RECORD and STATE messages to stdout as Singer JSON lines.
+
+    Messages are encoded as soon as they are written, so callers may keep
+    mutating `state` afterwards, and buffered until `buffer_size` is
+    reached. Everything goes through the same buffer, so a STATE message
+    can never overtake the records written before it. Call `flush` when
+    done.
+
+    Outputs also have `sync`, which only makes sure the records written so
+    far are out of the tap, without writing any STATE held back or
+    committing any open file.
+    """
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, stream=None):
+        self.buffer_size = buffer_size
+        self._stream = stream
+        self._buffer = []
+        self._buffered_size = 0
+
+    def _write(self, text):
+        self._buffer.append(text)
+        self._buffered_size += len(text)
+        if self._buffered_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            stream = self._stream or sys.stdout
+            stream.write(''.join(self._buffer))
+            stream.flush()
+            self._buffer = []
+            self._buffered_size = 0
+
+    def sync(self):
+        self.flush()
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self._write(dumps({"type": "SCHEMA",
+                           "stream": stream_name,
+                           "schema": schema,
+                           "key_properties": key_properties}) + '\n')
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        """
+        Writes a RECORD message for each of `records`, all sharing the same
+        `time_extracted`. The constant part of the message is only encoded
+        once per call.
+
+        Returns the number of records written.
+        """
+        prefix = '{"type":"RECORD","stream":' + dumps(stream_name) + ',"record":'
+        if time_extracted:
+            suffix = ',"time_extracted":' + dumps(utils.strftime(time_extracted.astimezone(timezone.utc))) + '}\n'
+        else:
+            suffix = '}\n'
+
+        count = 0
+        for record in records:
+            self._write(prefix + dumps(record) + suffix)
+            count += 1
+        return count
+
+    def write_state(self, state):
+        self._write(dumps({"type": "STATE", "value": state}) + '\n')
+
+    def write_batch(self, stream_name, manifest, encoding):
+        self._write(dumps({"type": "BATCH",
+                           "stream": stream_name,
+                           "encoding": encoding,
+                           "manifest": manifest}) + '\n')
+
+    def close(self):
+        self.flush()
+
+class FileOutput():
+    """
+    Base class for outputs that write records to files in `output_dir`
+    instead of stdout, one file per stream, view and report date.
+
+    Subclasses implement `_open_file`, `_write_file_records` and
+    `_commit_file`. STATE written while a file is open is held back until
+    that file has been committed, so a bookmark written to `output` is
+    never ahead of the records it covers.
+    """
+    def __init__(self, output, output_dir):
+        self.output = output
+        self.output_dir = output_dir
+        self.schemas = {}
+        self._file = None
+        self._pending_state = None
+
+    def _open_file(self, file_key, record):
+        raise NotImplementedError()
+
+    def _write_file_records(self, file, records):
+        raise NotImplementedError()
+
+    def _commit_file(self, file):
+        raise NotImplementedError()
+
+    def _close_file(self):
+        if self._file is not None:
+            file, self._file = self._file, None
+            self._commit_file(file)
+        if self._pending_state is not None:
+            self.output.write_state(self._pending_state)
+            self._pending_state = None
+
+    def write_schema(self, stream_name, schema, key_properties): # pylint: disable=unused-argument
+        self._close_file()
+        self.schemas[stream_name] = schema
+
+    def write_records(self, stream_name, records, time_extracted=None): # pylint: disable=unused-argument
+        count = 0
+        file_records = []
+        for record in records:
+            file_key = (stream_name, record.get("profile_id"), (record.get("start_date") or "")[:10])
+            if self._file is None or self._file["key"] != file_key:
+                if file_records:
+                    self._write_file_records(self._file, file_records)
+                    file_records = []
+                self._close_file()
+                self._file = self._open_file(file_key, record)
+                self._file["key"] = file_key
+            file_records.append(record)
+            count += 1
+        if file_records:
+            self._write_file_records(self._file, file_records)
+        return count
+
+    def write_state(self, state):
+        if self._file is None:
+            self.output.write_state(state)
+        else:
+            self._pending_state = copy.deepcopy(state)
+
+    def flush(self):
+        self._close_file()
+        self.output.flush()
+
+    def sync(self):
+        # NB: Records of the open file are only out of the tap once it's
+        # committed, which is why `get_output` rejects the modes that
+        # rely on this
+        self.output.sync()
+
+    def close(self):
+        self.flush()
+
+def _fsync(path):
+    with open(path, 'rb') as written_file:
+        os.fsync(written_file.fileno())
+
+def _safe_file_name(name):
+    return re.sub(r'[^\w.-]+', '_', name)
+
+class BatchOutput(FileOutput):
+    """
+    Writes records to gzipped JSONL files and emits a Singer BATCH message
+    for each file once it is complete. SCHEMA, BATCH and STATE messages go
+    to `output`.
+    """
+    encoding = {"format": "jsonl", "compression": "gzip"}
+
+    def _open_file(self, file_key, record): # pylint: disable=unused-argument
+        stream_name, profile_id, start_date = file_key
+        os.makedirs(self.output_dir, exist_ok=True)
+        file_name = "{}-{}-{}-{}.jsonl.gz".format(_safe_file_name(stream_name),
+                                                  profile_id,
+                                                  start_date,
+                                                  uuid.uuid4().hex)
+        path = os.path.join(self.output_dir, file_name)
+        return {"stream": stream_name,
+                "path": path,
+                "file": gzip.open(path, 'wb')}
+
+    def _write_file_records(self, file, records):
+        file["file"].write(''.join(dumps(record) + '\n' for record in records).encode('utf-8'))
+
+    def _commit_file(self, file):
+        file["file"].close()
+        _fsync(file["path"])
+        self.output.write_batch(file["stream"],
+                                [pathlib.Path(file["path"]).resolve().as_uri()],
+                                self.encoding)
+
+    def write_schema(self, stream_name, schema, key_properties):
+        super().write_schema(stream_name, schema, key_properties)
+        self.output.write_schema(stream_name, schema, key_properties)
+
+PARTITION_KEYS = ("profile_id", "start_date")
+
+# Default number of rows per Parquet row group
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+def schema_to_arrow_type(field_schema):
+    """
+    Maps a field's JSON schema, as generated by `type_to_schema` during
+    discovery, to an Arrow type. Fields that may hold more than one type
+    (e.g., `anyOf`, or integers with a string fallback) are kept as
+    strings.
+    """
+    types = field_schema.get("type") or []
+    types = set([types] if isinstance(types, str) else types) - {"null"}
+    if types == {"integer"}:
+        return pyarrow.int64()
+    if types == {"number"}:
+        return pyarrow.float64()
+    if types == {"boolean"}:
+        return pyarrow.bool_()
+    if types == {"string"} and field_schema.get("format") == "date-time":
+        return pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.string()
+
+def _to_arrow_value(arrow_type, value):
+    if value is None:
+        return None
+    if pyarrow.types.is_timestamp(arrow_type):
+        return utils.strptime_to_utc(value)
+    if pyarrow.types.is_string(arrow_type):
+        return str(value)
+    return value
+
+class ParquetOutput(FileOutput):
+    """
+    Writes records as Parquet files partitioned by stream, `profile_id`
+    and `start_date`, with column types derived from the stream's schema.
+    Files are written in row groups of at most `row_group_size` rows to a
+    hidden temporary name, and renamed into place once complete.
+
+    Only STATE messages go to `output`, so the orchestrator can persist
+    bookmarks without a Singer target.
+    """
+    def __init__(self, output, output_dir, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise Exception("Config Validation Error: output_mode parquet requires pyarrow to be installed.")
+        super().__init__(output, output_dir)
+        self.row_group_size = row_group_size
+
+    def _open_file(self, file_key, record):
+        stream_name, profile_id, start_date = file_key
+        properties = self.schemas[stream_name]["properties"]
+        # NB: Records only contain selected fields, so those become the
+        # columns, except for the partition keys which are in the path
+        arrow_schema = pyarrow.schema([(field_name, schema_to_arrow_type(field_schema))
+                                       for field_name, field_schema in properties.items()
+                                       if field_name in record and field_name not in PARTITION_KEYS])
+        partition_dir = os.path.join(self.output_dir,
+                                     _safe_file_name(stream_name),
+                                     "profile_id={}".format(profile_id),
+                                     "start_date={}".format(start_date))
+        os.makedirs(partition_dir, exist_ok=True)
+        file_name = "part-{}.parquet".format(uuid.uuid4().hex)
+        return {"path": os.path.join(partition_dir, file_name),
+                "tmp_path": os.path.join(partition_dir, "." + file_name + ".tmp"),
+                "schema": arrow_schema,
+                "writer": None,
+                "rows": []}
+
+    def _write_row_group(self, file):
+        arrow_schema = file["schema"]
+        columns = {field.name: [_to_arrow_value(field.type, row.get(field.name)) for row in file["rows"]]
+                   for field in arrow_schema}
+        if file["writer"] is None:
+            file["writer"] = pyarrow.parquet.ParquetWriter(file["tmp_path"], arrow_schema)
+        file["writer"].write_table(pyarrow.Table.from_pydict(columns, schema=arrow_schema))
+        file["rows"] = []
+
+    def _write_file_records(self, file, records):
+        for record in records:
+            file["rows"].append(record)
+            if len(file["rows"]) >= self.row_group_size:
+                self._write_row_group(file)
+
+    def _commit_file(self, file):
+        if file["rows"]:
+            self._write_row_group(file)
+        file["writer"].close()
+        _fsync(file["tmp_path"])
+        os.replace(file["tmp_path"], file["path"])
+
+# Sentinels understood by the QueuedOutput writer thread
+_FLUSH = object()
+_SYNC = object()
+_CLOSE = object()
+
+class QueuedOutput():
+    """
+    Hands messages to a dedicated writer thread through a bounded queue,
+    so a slow target draining stdout doesn't stall report requests, and
+    slow requests don't starve the target.
+
+    At most `max_queued` pages of records (or state messages) are held in
+    memory; writers block once the queue is full. Messages are written by
+    `output` in the order they were queued, so STATE stays behind the
+    records it covers.
+    """
+    def __init__(self, output, max_queued):
+        self.output = output
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="singer-output-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _CLOSE:
+                    return
+                if self._error is None:
+                    self._write(item)
+            except Exception as ex: # pylint: disable=broad-except
+                # NB: Keep draining the queue so producers never block forever
+                self._error = ex
+            finally:
+                self._queue.task_done()
+
+    def _write(self, item):
+        if item is _FLUSH:
+            self.output.flush()
+        elif item is _SYNC:
+            self.output.sync()
+        else:
+            method, args = item
+            getattr(self.output, method)(*args)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise Exception("Output writer thread failed") from self._error
+
+    def _put(self, item):
+        while True:
+            self._raise_if_failed()
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self._put(("write_schema", (stream_name, schema, key_properties)))
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        records = list(records)
+        self._put(("write_records", (stream_name, records, time_extracted)))
+        return len(records)
+
+    def write_state(self, state):
+        # NB: Callers keep mutating state, so queue a snapshot of it
+        self._put(("write_state", (copy.deepcopy(state),)))
+
+    def flush(self):
+        """ Blocks until everything queued so far has been written and flushed. """
+        self._put(_FLUSH)
+        self._queue.join()
+        self._raise_if_failed()
+
+    def sync(self):
+        """ Blocks until everything queued so far has been written and synced. """
+        self._put(_SYNC)
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.flush()
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+class CompactStateOutput():
+    """ Writes STATE messages in the compact layout of `compact_state`. """
+    def __init__(self, output):
+        self.output = output
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self.output.write_schema(stream_name, schema, key_properties)
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        return self.output.write_records(stream_name, records, time_extracted)
+
+    def write_state(self, state):
+        self.output.write_state(compact_state(state))
+
+    def flush(self):
+        self.output.flush()
+
+    def sync(self):
+        self.output.sync()
+
+    def close(self):
+        self.output.close()
+
+class CoalescedStateOutput():
+    """
+    Holds back STATE messages, writing only the latest one once
+    `interval_seconds` have passed or `interval_records` records have
+    been written since the last one, whichever comes first.
+
+    The state is always written when the stream or view being synced
+    changes, and when the output is flushed or closed. A held state is
+    written after the records that preceded it, never ahead of them.
+    """
+    def __init__(self, output, interval_seconds=None, interval_records=None):
+        self.output = output
+        self.interval_seconds = interval_seconds
+        self.interval_records = interval_records
+        self._pending_state = None
+        self._last_written = time.monotonic()
+        self._records_since_state = 0
+        self._syncing = None
+
+    def _write_pending_state(self):
+        if self._pending_state is not None:
+            self.output.write_state(self._pending_state)
+            self._pending_state = None
+        self._last_written = time.monotonic()
+        self._records_since_state = 0
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self.output.write_schema(stream_name, schema, key_properties)
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        record_count = self.output.write_records(stream_name, records, time_extracted)
+        self._records_since_state += record_count
+        return record_count
+
+    def write_state(self, state):
+        # NB: Callers keep mutating state, so hold a snapshot of it
+        self._pending_state = copy.deepcopy(state)
+        syncing = (state.get("currently_syncing"), state.get("currently_syncing_view"))
+        if (syncing != self._syncing or
+                (self.interval_seconds is not None and
+                 time.monotonic() - self._last_written >= self.interval_seconds) or
+                (self.interval_records is not None and
+                 self._records_since_state >= self.interval_records)):
+            self._syncing = syncing
+            self._write_pending_state()
+
+    def flush(self):
+        self._write_pending_state()
+        self.output.flush()
+
+    def sync(self):
+        # NB: The held state is left for its interval
+        self.output.sync()
+
+    def close(self):
+        self._write_pending_state()
+        self.output.close()
+
+class OutputCancelledError(Exception):
+    pass
+
+# Marks the end of the messages in a MessageOutput queue
+_DONE = object()
+
+class MessageOutput():
+    """
+    Queues messages as singer-python `SchemaMessage`, `RecordMessage` and
+    `StateMessage` objects for an in-process consumer reading `messages()`
+    on another thread, so no JSON is involved.
+
+    At most `max_queued` pages of records (or state messages) are held in
+    memory. Records are the transformed Python dicts. State is a snapshot
+    taken when it was written.
+    """
+    def __init__(self, max_queued):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._cancelled = threading.Event()
+
+    def _put(self, item):
+        while True:
+            if self._cancelled.is_set():
+                raise OutputCancelledError("The consumer stopped reading messages.")
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self._put([singer.SchemaMessage(stream=stream_name, schema=schema, key_properties=key_properties)])
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        messages = [singer.RecordMessage(stream=stream_name, record=record, time_extracted=time_extracted)
+                    for record in records]
+        self._put(messages)
+        return len(messages)
+
+    def write_state(self, state):
+        self._put([singer.StateMessage(value=copy.deepcopy(state))])
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def finish(self, error=None):
+        """ Called by the producer once it's done, with the exception that stopped it, if any. """
+        if not self._cancelled.is_set():
+            self._queue.put((_DONE, error))
+
+    def cancel(self):
+        """ Called by the consumer to stop the producer, e.g., when it stops iterating early. """
+        self._cancelled.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def messages(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, tuple) and item[0] is _DONE:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield from item
+
+def get_output(config):
+    """
+    Returns the output for a sync, based on `output_mode`:
+    - "singer" (default) - RECORD messages on stdout
+    - "batch" - gzipped JSONL files in `output_dir`, announced by BATCH messages
+    - "parquet" - Parquet files in `output_dir`, with only STATE on stdout
+
+    When `output_queue_size` is configured, output is written from a
+    separate thread holding up to that many pages.
+
+    `journal_path` and `row_index_path` record pages and rows as written
+    once they're out of the tap, which records in an open batch or Parquet
+    file aren't, so those modes can't be combined with them.
+
+    When `compact_state` is set, STATE messages group the views of each
+    stream by their bookmarked date. When `state_interval_seconds` or
+    `state_interval_records` is configured, STATE messages are coalesced
+    to one per interval.
+    """
+    output_mode = config.get("output_mode") or "singer"
+    output = SingerOutput()
+    if output_mode in ("batch", "parquet") and not config.get("output_dir"):
+        raise Exception("Config Validation Error: output_dir is required when output_mode is {}.".format(output_mode))
+    if output_mode in ("batch", "parquet") and (config.get("journal_path") or config.get("row_index_path")):
+        raise Exception("Config Validation Error: journal_path and row_index_path can't be used when output_mode is {}.".format(output_mode))
+    if output_mode == "batch":
+        output = BatchOutput(output, config["output_dir"])
+    elif output_mode == "parquet":
+        output = ParquetOutput(output,
+                               config["output_dir"],
+                               int(config.get("row_group_size") or DEFAULT_ROW_GROUP_SIZE))
+    elif output_mode != "singer":
+        raise Exception("Config Validation Error: Unknown output_mode: {}".format(output_mode))
+    max_queued = int(config.get("output_queue_size") or 0)
+    if max_queued > 0:
+        output = QueuedOutput(output, max_queued)
+    if config.get("compact_state"):
+        output = CompactStateOutput(output)
+    interval_seconds = config.get("state_interval_seconds")
+    interval_records = config.get("state_interval_records")
+    if interval_seconds or interval_records:
+        output = CoalescedStateOutput(output,
+                                      float(interval_seconds) if interval_seconds else None,
+                                      int(interval_records) if interval_records else None)
+    return output
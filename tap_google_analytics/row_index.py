@@ -0,0 +1,112 @@
+import hashlib
+import json
+import sqlite3
+
+import singer
+
+from .journal import WorkJournal
+
+LOGGER = singer.get_logger()
+
+def get_row_digest(record, metrics):
+    """ Returns an 8 byte digest of the metric values of `record`. """
+    return hashlib.sha1(json.dumps([record.get(m) for m in metrics]).encode('utf-8')).digest()[:8]
+
+class RowDigestIndex():
+    """
+    SQLite index of the rows written for the days of one view's report
+    that aren't golden, mapping each row's `_sdc_record_hash` to a digest
+    of its metric values.
+
+    Records whose hash and digest are in the index were written by an
+    earlier sync and haven't changed, so they are left out. A day's rows
+    are forgotten once it completes golden, since it won't be synced
+    again.
+
+    As in the `WorkJournal`, the date each report last started syncing
+    from is kept, and a sync that starts before it had its state reset,
+    so it forgets the report's rows to write them all again.
+    """
+    def __init__(self, path, report):
+        self.report = report
+        self._report_key = hashlib.sha1(WorkJournal.get_report_key(report).encode('utf-8')).digest()[:8]
+        self._connection = sqlite3.connect(path, timeout=30)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS rows (
+                                          report_key BLOB NOT NULL,
+                                          report_date TEXT NOT NULL,
+                                          record_hash BLOB NOT NULL,
+                                          digest BLOB NOT NULL,
+                                          PRIMARY KEY (report_key, report_date, record_hash)) WITHOUT ROWID""")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                                          report_key BLOB NOT NULL PRIMARY KEY,
+                                          start_date TEXT NOT NULL)""")
+        # Digests of the days being synced, by record hash
+        self._days = {}
+        self._pending_rows = []
+
+    def _get_day_digests(self, report_date):
+        if report_date not in self._days:
+            rows = self._connection.execute("SELECT record_hash, digest FROM rows WHERE report_key = ? AND report_date = ?",
+                                            (self._report_key, report_date.strftime("%Y-%m-%d"))).fetchall()
+            self._days[report_date] = dict(rows)
+        return self._days[report_date]
+
+    def changed_records(self, report_date, records):
+        """
+        Yields the records of `report_date` that are new or whose metrics
+        changed. They are added to the index on `commit`.
+        """
+        day_digests = self._get_day_digests(report_date)
+        unchanged_records = 0
+        for record in records:
+            record_hash = bytes.fromhex(record["_sdc_record_hash"])
+            digest = get_row_digest(record, self.report["metrics"])
+            if day_digests.get(record_hash) == digest:
+                unchanged_records += 1
+                continue
+            self._pending_rows.append((report_date, record_hash, digest))
+            yield record
+        if unchanged_records:
+            LOGGER.info("Skipped %s unchanged records of %s for view_id %s and date %s",
+                        unchanged_records, self.report["name"], self.report["profile_id"],
+                        report_date.strftime("%Y-%m-%d"))
+
+    def commit(self):
+        """ Adds the records yielded by `changed_records` since the last commit, once they're written. """
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)",
+                                         [(self._report_key, report_date.strftime("%Y-%m-%d"), record_hash, digest)
+                                          for report_date, record_hash, digest in self._pending_rows])
+        for report_date, record_hash, digest in self._pending_rows:
+            self._get_day_digests(report_date)[record_hash] = digest
+        self._pending_rows = []
+
+    def day_done(self, report_date, is_data_golden):
+        self._days.pop(report_date, None)
+        if is_data_golden:
+            with self._connection:
+                self._connection.execute("DELETE FROM rows WHERE report_key = ? AND report_date = ?",
+                                         (self._report_key, report_date.strftime("%Y-%m-%d")))
+
+    def start_sync(self, start_date):
+        """ Prepares the index for a sync from `start_date`, forgetting every row if it starts before the last sync did. """
+        start_date_string = start_date.strftime("%Y-%m-%d")
+        with self._connection:
+            row = self._connection.execute("SELECT start_date FROM syncs WHERE report_key = ?", (self._report_key,)).fetchone()
+            if row and start_date_string < row[0]:
+                LOGGER.info("%s for view_id %s starts before its last sync (%s), forgetting its indexed rows.",
+                            self.report["name"], self.report["profile_id"], row[0])
+                self._connection.execute("DELETE FROM rows WHERE report_key = ?", (self._report_key,))
+            self._connection.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?)", (self._report_key, start_date_string))
+        self.prune(start_date)
+
+    def prune(self, start_date):
+        """ Forgets the days before `start_date`, which are covered by the bookmark. """
+        with self._connection:
+            self._connection.execute("DELETE FROM rows WHERE report_key = ? AND report_date < ?",
+                                     (self._report_key, start_date.strftime("%Y-%m-%d")))
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,120 @@
+import multiprocessing
+import queue
+import traceback
+
+import singer
+
+from .client import Client
+from .sync import sync_report
+
+LOGGER = singer.get_logger()
+
+# Workers are spawned rather than forked, since the parent may be running threads
+MULTIPROCESSING_CONTEXT = "spawn"
+
+# Messages each worker may have queued for the parent before it blocks
+MESSAGES_PER_PROCESS = 4
+
+class ProcessOutput():
+    """
+    Output used by view sync processes. Sends pages of transformed records
+    and the bookmark of the view being synced to the parent process, which
+    writes them to its own output in the order they were sent.
+    """
+    def __init__(self, messages, tap_stream_id):
+        self.messages = messages
+        self.tap_stream_id = tap_stream_id
+        # The view being synced, set before each of its reports
+        self.view_id = None
+
+    def write_schema(self, stream_name, schema, key_properties): # pylint: disable=unused-argument
+        pass
+
+    def write_records(self, stream_name, records, time_extracted=None):
+        records = list(records)
+        self.messages.put(("records", (stream_name, records, time_extracted)))
+        return len(records)
+
+    def write_state(self, state):
+        # NB: The process' copy of the other views' bookmarks is stale, so only this view's is sent
+        view_bookmarks = state.get("bookmarks", {}).get(self.tap_stream_id, {})
+        if self.view_id in view_bookmarks:
+            self.messages.put(("bookmarks", (self.tap_stream_id, {self.view_id: view_bookmarks[self.view_id]})))
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+def merge_view_bookmarks(state, tap_stream_id, view_bookmarks):
+    """
+    Merges the bookmark of the view a view sync process is syncing into
+    `state`. Processes sync disjoint views and only report the view they
+    are syncing, so they never overwrite each other.
+    """
+    for view_id, bookmark in view_bookmarks.items():
+        state = singer.write_bookmark(state, tap_stream_id, view_id, bookmark)
+    return state
+
+def _sync_reports(config, schema, reports, end_date, state, messages):
+    """ Entry point of a view sync process. """
+    try:
+        client = Client(config)
+        output = ProcessOutput(messages, reports[0][0]["id"])
+        for report, is_historical_sync, start_date in reports:
+            output.view_id = report["profile_id"]
+            sync_report(client, schema, report, start_date, end_date, state, is_historical_sync, output, config)
+        messages.put(("done", None))
+    except Exception: # pylint: disable=broad-except
+        messages.put(("error", traceback.format_exc()))
+
+def sync_reports_in_processes(config, schema, reports, end_date, state, output, processes):
+    """
+    Syncs `reports`, a list of `(report, is_historical_sync, start_date)`
+    for one stream, sharding its views across up to `processes` worker
+    processes that each use their own `Client`.
+
+    Records from all processes are written to `output` as they arrive,
+    and each bookmark a process reports is merged into `state` before it
+    is written, so the result is one Singer stream and one state.
+    """
+    context = multiprocessing.get_context(MULTIPROCESSING_CONTEXT)
+    messages = context.Queue(maxsize=processes * MESSAGES_PER_PROCESS)
+    shards = [reports[i::processes] for i in range(processes)]
+    workers = [context.Process(target=_sync_reports,
+                               args=(config, schema, shard, end_date, state, messages),
+                               daemon=True)
+               for shard in shards if shard]
+    LOGGER.info("Syncing %s views in %s processes", len(reports), len(workers))
+    for worker in workers:
+        worker.start()
+
+    try:
+        workers_running = len(workers)
+        while workers_running:
+            try:
+                kind, message = messages.get(timeout=1)
+            except queue.Empty:
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise Exception("A view sync process exited unexpectedly.") from None
+                continue
+
+            if kind == "records":
+                output.write_records(*message)
+            elif kind == "bookmarks":
+                state = merge_view_bookmarks(state, *message)
+                output.write_state(state)
+            elif kind == "error":
+                raise Exception("A view sync process failed:\n{}".format(message))
+            else:
+                workers_running -= 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+    return state
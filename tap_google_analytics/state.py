@@ -0,0 +1,76 @@
+COMPACT_STATE_VERSION = 2
+
+# Key of the views grouped by `last_report_date` in a compact stream bookmark
+GROUPED_VIEWS_KEY = "last_report_dates"
+
+def _encode_ranges(indexes):
+    """ Encodes sorted integers as runs, e.g., [0, 1, 2, 5, 7, 8] as "0-2,5,7-8". """
+    runs = []
+    for index in indexes:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    return ",".join(str(start) if start == end else "{}-{}".format(start, end) for start, end in runs)
+
+def _decode_ranges(ranges):
+    for run in ranges.split(","):
+        start, _, end = run.partition("-")
+        yield from range(int(start), int(end or start) + 1)
+
+def compact_state(state):
+    """
+    Returns `state` in the compact layout. The view IDs are listed once,
+    and the views of each stream that only have a `last_report_date` are
+    grouped by that date, as runs of their positions in that list:
+
+    {"state_version": 2,
+     "view_ids": ["12345", "67890", "13579"],
+     "bookmarks": {"report": {"last_report_dates": {"2020-04-01": "0-1"},
+                              "13579": {"last_report_date": "2020-04-01", "page_checkpoint": {...}}}}}
+
+    Bookmarks with anything else keep it as is, even if the same view is
+    grouped in another stream. `state` is left unchanged.
+    """
+    def is_grouped(bookmark):
+        return isinstance(bookmark, dict) and list(bookmark) == ["last_report_date"]
+
+    grouped_view_ids = sorted({view_id
+                               for stream_bookmarks in state.get("bookmarks", {}).values()
+                               for view_id, bookmark in stream_bookmarks.items()
+                               if is_grouped(bookmark)})
+    view_indexes = {view_id: index for index, view_id in enumerate(grouped_view_ids)}
+
+    compacted = dict(state, state_version=COMPACT_STATE_VERSION, view_ids=grouped_view_ids)
+    compacted["bookmarks"] = {}
+    for tap_stream_id, stream_bookmarks in state.get("bookmarks", {}).items():
+        compact_bookmarks = {}
+        grouped_views = {}
+        for view_id, bookmark in stream_bookmarks.items():
+            if is_grouped(bookmark):
+                grouped_views.setdefault(bookmark["last_report_date"], []).append(view_indexes[view_id])
+            else:
+                compact_bookmarks[view_id] = bookmark
+        if grouped_views:
+            compact_bookmarks[GROUPED_VIEWS_KEY] = {last_report_date: _encode_ranges(sorted(indexes))
+                                                   for last_report_date, indexes in grouped_views.items()}
+        compacted["bookmarks"][tap_stream_id] = compact_bookmarks
+    return compacted
+
+def expand_state(state):
+    """
+    Converts a compact `state` back to one bookmark per view, in place, as
+    the sync expects it. States in the regular layout are left as they are.
+    """
+    state_version = state.pop("state_version", None)
+    if state_version is None:
+        return state
+    if state_version != COMPACT_STATE_VERSION:
+        raise Exception("State Validation Error: Unknown state_version: {}".format(state_version))
+
+    view_ids = state.pop("view_ids", [])
+    for stream_bookmarks in state.get("bookmarks", {}).values():
+        for last_report_date, ranges in stream_bookmarks.pop(GROUPED_VIEWS_KEY, {}).items():
+            for index in _decode_ranges(ranges):
+                stream_bookmarks[view_ids[index]] = {"last_report_date": last_report_date}
+    return state
@@ -1,8 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
+import collections
 import hashlib
 import json
+import queue
+import threading
 import singer
 from singer import Transformer
+from .archive import ResponseArchive, get_archived_report_pages
+from .journal import JournalClient, WorkJournal, journaled_page
+from .output import SingerOutput
+from .row_index import RowDigestIndex
 
 LOGGER = singer.get_logger()
 
@@ -48,6 +56,253 @@ def generate_report_dates(start_date, end_date):
     for day_offset in range(total_days + 1):
         yield start_date + timedelta(days=day_offset)
 
+# Pages of responses buffered ahead of the one being processed, when prefetching
+DEFAULT_PREFETCH_PAGES = 10
+
+class _PrefetchError():
+    def __init__(self, error):
+        self.error = error
+
+def _put_until_cancelled(pages_queue, item, cancelled):
+    while not cancelled.is_set():
+        try:
+            pages_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+def get_day_report(client, report, report_date, page_checkpoint=None):
+    """
+    Requests the pages of one day of `report`, starting after the page in
+    `page_checkpoint` if it was left on that day.
+    """
+    if page_checkpoint and page_checkpoint["report_date"] == report_date.strftime("%Y-%m-%d"):
+        LOGGER.info("Resuming %s for view_id %s and date %s from its page checkpoint (nextPageToken: %s)",
+                    report['name'], report['profile_id'], page_checkpoint["report_date"],
+                    page_checkpoint["next_page_token"])
+        return client.get_report(report['name'], report['profile_id'],
+                                 report_date, report['metrics'],
+                                 report['dimensions'], page_token=page_checkpoint["next_page_token"])
+    return client.get_report(report['name'], report['profile_id'],
+                             report_date, report['metrics'],
+                             report['dimensions'])
+
+def unchanged_day(raw_report_response):
+    """ Returns whether a response stands in for a day that hasn't changed since it was last synced. """
+    return raw_report_response.get("unchangedDay", False)
+
+class UnchangedDaysClient():
+    """
+    Wraps a `Client` so that `get_report` stops after the first page of a
+    day that isn't golden when its `dataLastRefreshed` is the one in
+    `data_last_refreshed`, from the last sync of the day.
+
+    That page is replaced by one without rows, marked as an unchanged
+    day, so none of the day's records are written again.
+    """
+    def __init__(self, client, data_last_refreshed):
+        self.client = client
+        self.data_last_refreshed = data_last_refreshed
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_report(self, name, profile_id, report_date, metrics, dimensions, page_token=None):
+        pages = iter(self.client.get_report(name, profile_id, report_date, metrics, dimensions, page_token=page_token))
+        first_page = next(pages, None)
+        if first_page is None:
+            return
+
+        data = first_page["reports"][0].get("data", {})
+        last_refreshed = data.get("dataLastRefreshed")
+        report_date_string = report_date.strftime("%Y-%m-%d")
+        if (page_token is None and last_refreshed and not data.get("isDataGolden") and
+                self.data_last_refreshed.get(report_date_string) == last_refreshed):
+            LOGGER.info("%s for view_id %s and date %s is unchanged since %s, skipping it.",
+                        name, profile_id, report_date_string, last_refreshed)
+            yield dict(first_page,
+                       reports=[dict(first_page["reports"][0],
+                                     data={"isDataGolden": data.get("isDataGolden"),
+                                           "dataLastRefreshed": last_refreshed},
+                                     nextPageToken=None)],
+                       unchangedDay=True)
+            return
+
+        yield first_page
+        yield from pages
+
+def _prefetch_day(client, report, report_date, pages_queue, cancelled, page_checkpoint=None):
+    """
+    Puts `(report_date, raw_report_response)` on `pages_queue` for each
+    page of the day, followed by `(report_date, None)` once it's complete.
+    """
+    if cancelled.is_set():
+        return
+    try:
+        for raw_report_response in get_day_report(client, report, report_date, page_checkpoint):
+            if cancelled.is_set():
+                return
+            _put_until_cancelled(pages_queue, (report_date, raw_report_response), cancelled)
+        _put_until_cancelled(pages_queue, (report_date, None), cancelled)
+    except Exception as ex: # pylint: disable=broad-except
+        _put_until_cancelled(pages_queue, (report_date, _PrefetchError(ex)), cancelled)
+
+def _read_prefetched_pages(pages_queue):
+    while True:
+        _, item = pages_queue.get()
+        if item is None:
+            return
+        if isinstance(item, _PrefetchError):
+            raise item.error
+        yield item
+
+def get_daily_reports(client, report, start_date, end_date, prefetch_days=0, prefetch_pages=DEFAULT_PREFETCH_PAGES, # pylint: disable=too-many-arguments
+                      page_checkpoint=None):
+    """
+    Yields `(report_date, pages)` for each day from `start_date` to
+    `end_date`, in order, where `pages` is an iterator of the raw report
+    responses for that day.
+
+    With `prefetch_days` > 0, the pages of that many days are requested on
+    background threads while the current page is processed. Each day
+    buffers at most `prefetch_pages / prefetch_days` pages, so no more than
+    `prefetch_pages` responses are held in memory at once.
+
+    The day of `page_checkpoint`, if any, resumes after its page.
+    """
+    report_dates = generate_report_dates(start_date, end_date)
+    if prefetch_days <= 0:
+        for report_date in report_dates:
+            yield report_date, get_day_report(client, report, report_date, page_checkpoint)
+        return
+
+    pages_per_day = max(1, prefetch_pages // prefetch_days)
+    cancelled = threading.Event()
+    in_flight = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=prefetch_days, thread_name_prefix="report-prefetch")
+
+    def prefetch_next_day():
+        report_date = next(report_dates, None)
+        if report_date is not None:
+            pages_queue = queue.Queue(maxsize=pages_per_day)
+            executor.submit(_prefetch_day, client, report, report_date, pages_queue, cancelled, page_checkpoint)
+            in_flight.append((report_date, pages_queue))
+
+    try:
+        for _ in range(prefetch_days):
+            prefetch_next_day()
+        while in_flight:
+            report_date, pages_queue = in_flight.popleft()
+            prefetch_next_day()
+            yield report_date, _read_prefetched_pages(pages_queue)
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
+
+def get_report_pages(client, report, start_date, end_date, config, page_checkpoint=None):
+    """
+    Yields `(report_date, raw_report_response)` for every page of every
+    day from `start_date` to `end_date`, and `(report_date, None)` once
+    all of a day's pages have been yielded.
+
+    By default, days and pages come in order, prefetched as configured by
+    `prefetch_days` and `prefetch_pages`. With `parallel_days` > 1, that
+    many days are requested at once and their pages are yielded as they
+    arrive, so days may interleave and finish out of order. At most
+    `prefetch_pages` responses are buffered either way.
+
+    The day of `page_checkpoint`, if any, resumes after its page.
+    """
+    parallel_days = int(config.get("parallel_days") or 0)
+    prefetch_pages = int(config.get("prefetch_pages") or DEFAULT_PREFETCH_PAGES)
+    if parallel_days <= 1:
+        for report_date, raw_report_responses in get_daily_reports(client, report, start_date, end_date,
+                                                                   int(config.get("prefetch_days") or 0),
+                                                                   prefetch_pages,
+                                                                   page_checkpoint):
+            for raw_report_response in raw_report_responses:
+                yield report_date, raw_report_response
+            yield report_date, None
+        return
+
+    pages_queue = queue.Queue(maxsize=max(1, prefetch_pages))
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=parallel_days, thread_name_prefix="report-parallel")
+    try:
+        days_remaining = 0
+        for report_date in generate_report_dates(start_date, end_date):
+            executor.submit(_prefetch_day, client, report, report_date, pages_queue, cancelled, page_checkpoint)
+            days_remaining += 1
+        while days_remaining:
+            report_date, item = pages_queue.get()
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            if item is None:
+                days_remaining -= 1
+            yield report_date, item
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
+
+class BookmarkTracker():
+    """
+    Decides which report date to bookmark as the pages and days of a
+    report complete, possibly out of order.
+
+    Pages are applied in date order, so a day finishing early is held
+    until every day before it has finished. Bookmarks only ever cover the
+    contiguous prefix of finished days.
+    """
+    def __init__(self, report_dates, historically_syncing=False):
+        self.historically_syncing = historically_syncing
+        self.all_data_golden = True
+        # Whether the first day's data was golden, once its first page is applied
+        self.first_day_golden = None
+        self._unfinished_days = collections.deque(report_dates)
+        self._finished_days = set()
+        self._pending_pages = {}
+
+    def _apply_page(self, report_date, is_data_golden):
+        # NB: Bookmark all days with "golden" data until you find the first non-golden day
+        # - "golden" refers to data that will not change in future
+        #   requests, so we can use it as a bookmark
+        if self.first_day_golden is None:
+            self.first_day_golden = bool(is_data_golden)
+        if self.historically_syncing:
+            # Switch to regular bookmarking at first golden
+            self.historically_syncing = not is_data_golden
+
+        # The assumption here is that today's data cannot be golden if yesterday's is also not golden
+        if self.all_data_golden and not self.historically_syncing:
+            if not is_data_golden:
+                # Stop bookmarking on first "isDataGolden": False
+                self.all_data_golden = False
+            return report_date
+        LOGGER.info("Did not detect that data was golden. Skipping writing bookmark.")
+        return None
+
+    def _apply_ready_pages(self):
+        bookmark_date = None
+        while self._unfinished_days:
+            report_date = self._unfinished_days[0]
+            for is_data_golden in self._pending_pages.pop(report_date, []):
+                bookmark_date = self._apply_page(report_date, is_data_golden) or bookmark_date
+            if report_date not in self._finished_days:
+                break
+            self._unfinished_days.popleft()
+            self._finished_days.discard(report_date)
+        return bookmark_date
+
+    def page_done(self, report_date, is_data_golden):
+        """ Returns the date to bookmark now, if any. """
+        self._pending_pages.setdefault(report_date, []).append(is_data_golden)
+        return self._apply_ready_pages()
+
+    def day_done(self, report_date):
+        """ Returns the date to bookmark now, if any. """
+        self._finished_days.add(report_date)
+        return self._apply_ready_pages()
+
 def report_to_records(raw_report):
     """
     Parse a single report object into Singer records, with added runtime info and PK.
@@ -116,7 +371,7 @@ def transform_datetimes(report_name, rec):
         LOGGER.warning(f"Row limit reached for report: {report_name}. See https://support.google.com/analytics/answer/9309767 for more info.")
     return rec
 
-def sync_report(client, schema, report, start_date, end_date, state, historically_syncing=False):
+def sync_report(client, schema, report, start_date, end_date, state, historically_syncing=False, output=None, config=None): # pylint: disable=too-many-arguments
     """
     Run a sync, beginning from either the start_date or bookmarked date,
     requesting a report per day, until the last full day of data. (e.g.,
@@ -126,46 +381,180 @@ def sync_report(client, schema, report, start_date, end_date, state, historicall
               "profile_id": view_id,
               "metrics": metrics,
               "dimensions": dimensions}
+
+    Records and state are written to `output`, a `SingerOutput` by
+    default. A caller-provided `output` is left for the caller to flush.
+
+    Returns the `BookmarkTracker`, which tells how bookmarking ended.
+
+    `config` may tune how reports are requested:
+    - prefetch_days - days requested ahead of the one being processed
+    - parallel_days - days requested and processed at once, in any order
+    - prefetch_pages - max responses buffered by those requests
+    - journal_path - SQLite journal of written pages, to resume from after a failure
+    - archive_dir - directory to archive every raw response in
+    - replay_archive_dir - replays the responses archived in this directory, without requests
+    - row_index_path - SQLite index of the rows written for days that
+      aren't golden, so syncing them again only writes new or changed rows
+    - skip_unchanged_days - skips days that aren't golden when their data
+      hasn't been refreshed since they were last synced, per the
+      `data_last_refreshed` of the view's bookmark
+
+    Bookmarks written mid-day on a golden day carry a `page_checkpoint`
+    with the day's last written `nextPageToken`, which the next sync
+    resumes that day from. It's dropped once the day completes.
     """
+    if output is None:
+        output = SingerOutput()
+        try:
+            return sync_report(client, schema, report, start_date, end_date, state,
+                               historically_syncing, output, config)
+        finally:
+            output.flush()
+    config = config or {}
+
     LOGGER.info("Syncing %s for view_id %s", report['name'], report['profile_id'])
 
-    all_data_golden = True
+    if config.get("replay_archive_dir"):
+        LOGGER.info("Replaying %s for view_id %s from %s", report['name'], report['profile_id'], config["replay_archive_dir"])
+        report_pages = get_archived_report_pages(config["replay_archive_dir"], report, start_date, end_date)
+        return _sync_report_pages(report_pages, schema, report, start_date, end_date, state,
+                                  historically_syncing, output)
+
+    journal = None
+    archive = None
+    row_index = None
+    if config.get("journal_path"):
+        journal = WorkJournal(config["journal_path"])
+        journal.start_sync(report, start_date)
+        client = JournalClient(client, journal, report)
+    if config.get("archive_dir"):
+        archive = ResponseArchive(config["archive_dir"], report)
+    if config.get("row_index_path"):
+        row_index = RowDigestIndex(config["row_index_path"], report)
+        row_index.start_sync(start_date)
+    if config.get("skip_unchanged_days"):
+        client = UnchangedDaysClient(client, get_data_last_refreshed(state, report))
+    try:
+        report_pages = get_report_pages(client, report, start_date, end_date, config,
+                                        get_page_checkpoint(state, report, start_date))
+        return _sync_report_pages(report_pages, schema, report, start_date, end_date, state,
+                                  historically_syncing, output, journal, archive, row_index,
+                                  bool(config.get("skip_unchanged_days")))
+    finally:
+        if journal:
+            journal.close()
+        if archive:
+            archive.close()
+        if row_index:
+            row_index.close()
+
+def get_page_checkpoint(state, report, start_date):
+    """
+    Returns the view's page checkpoint, if it was left on `start_date`,
+    the day its sync resumes from.
+    """
+    page_checkpoint = singer.get_bookmark(state, report["id"], report["profile_id"], {}).get("page_checkpoint")
+    if page_checkpoint and page_checkpoint["report_date"] == start_date.strftime("%Y-%m-%d"):
+        return page_checkpoint
+    return None
+
+def get_data_last_refreshed(state, report):
+    """ Returns the `dataLastRefreshed` of the days of the view synced while they weren't golden. """
+    return singer.get_bookmark(state, report["id"], report["profile_id"], {}).get("data_last_refreshed", {})
+
+def _sync_report_pages(report_pages, schema, report, start_date, end_date, state, historically_syncing, output, journal=None, archive=None, row_index=None, skip_unchanged_days=False): # pylint: disable=too-many-arguments,too-many-locals
     # TODO: Is it better to query by multiple days if `ga:date` is present?
     # - If so, we can optimize the calls here to generate date ranges and reduce request volume
-    for report_date in generate_report_dates(start_date, end_date):
-        for raw_report_response in client.get_report(report['name'], report['profile_id'],
-                                                     report_date, report['metrics'],
-                                                     report['dimensions']):
-
-            with singer.metrics.record_counter(report['name']) as counter:
-                time_extracted = singer.utils.now()
-                with Transformer() as transformer:
-                    for rec in report_to_records(raw_report_response):
-                        singer.write_record(report["name"],
-                                            transformer.transform(
-                                                transform_datetimes(report["name"], rec),
-                                                schema),
-                                            time_extracted=time_extracted)
-                        counter.increment()
-
-                # NB: Bookmark all days with "golden" data until you find the first non-golden day
-                # - "golden" refers to data that will not change in future
-                #   requests, so we can use it as a bookmark
-                is_data_golden = raw_report_response["reports"][0]["data"].get("isDataGolden")
-                if historically_syncing:
-                    # Switch to regular bookmarking at first golden
-                    historically_syncing = not is_data_golden
-
-                # The assumption here is that today's data cannot be golden if yesterday's is also not golden
-                if all_data_golden and not historically_syncing:
-                    singer.write_bookmark(state,
-                                          report["id"],
-                                          report['profile_id'],
-                                          {'last_report_date': report_date.strftime("%Y-%m-%d")})
-                    singer.write_state(state)
-                    if not is_data_golden and not historically_syncing:
-                        # Stop bookmarking on first "isDataGolden": False
-                        all_data_golden = False
-                else:
-                    LOGGER.info("Did not detect that data was golden. Skipping writing bookmark.")
+    bookmarks = BookmarkTracker(generate_report_dates(start_date, end_date), historically_syncing)
+    page_checkpoint = get_page_checkpoint(state, report, start_date)
+    # dataLastRefreshed of the days being synced that aren't golden
+    refreshed_days = {}
+    golden_days = set()
+    for report_date, raw_report_response in report_pages:
+        if raw_report_response is None:
+            bookmark_date = bookmarks.day_done(report_date)
+            if row_index:
+                row_index.day_done(report_date, report_date in golden_days)
+            golden_days.discard(report_date)
+            last_refreshed = refreshed_days.pop(report_date, None)
+            view_bookmark = singer.get_bookmark(state, report["id"], report['profile_id'], {})
+            # NB: Only remember the day as synced once all of its records are
+            # written, and in a bookmark that has a `last_report_date` already
+            if last_refreshed and view_bookmark.get('last_report_date'):
+                data_last_refreshed = dict(get_data_last_refreshed(state, report))
+                data_last_refreshed[report_date.strftime("%Y-%m-%d")] = last_refreshed
+                singer.write_bookmark(state,
+                                      report["id"],
+                                      report['profile_id'],
+                                      dict(view_bookmark, data_last_refreshed=data_last_refreshed))
+                if not bookmark_date:
+                    output.write_state(state)
+            if page_checkpoint and page_checkpoint["report_date"] == report_date.strftime("%Y-%m-%d"):
+                # NB: The day is complete, so its sync no longer resumes mid-day
+                page_checkpoint = None
+                if not bookmark_date:
+                    bookmark = singer.get_bookmark(state, report["id"], report['profile_id'], {})
+                    bookmark.pop("page_checkpoint", None)
+                    output.write_state(state)
+        else:
+            synced_before = journaled_page(raw_report_response) or unchanged_day(raw_report_response)
+            if not synced_before:
+                with singer.metrics.record_counter(report['name']) as counter:
+                    time_extracted = singer.utils.now()
+                    with Transformer() as transformer:
+                        raw_records = report_to_records(raw_report_response)
+                        if row_index:
+                            raw_records = row_index.changed_records(report_date, raw_records)
+                        records = (transformer.transform(transform_datetimes(report["name"], rec), schema)
+                                   for rec in raw_records)
+                        counter.increment(output.write_records(report["name"],
+                                                               records,
+                                                               time_extracted=time_extracted))
+                if archive:
+                    archive.write_page(raw_report_response)
+                if row_index:
+                    # NB: Only index rows once they are out of the tap
+                    output.sync()
+                    row_index.commit()
+
+            is_data_golden = raw_report_response["reports"][0]["data"].get("isDataGolden")
+            next_page_token = raw_report_response["reports"][0].get("nextPageToken")
+            if is_data_golden:
+                golden_days.add(report_date)
+            last_refreshed = raw_report_response["reports"][0]["data"].get("dataLastRefreshed")
+            if skip_unchanged_days and not synced_before and not is_data_golden and last_refreshed:
+                refreshed_days.setdefault(report_date, last_refreshed)
+            if journal and not synced_before:
+                # NB: Only journal pages once their records are out of the tap
+                output.sync()
+                journal.page_written(report,
+                                     report_date,
+                                     raw_report_response.get("pageToken"),
+                                     next_page_token,
+                                     is_data_golden)
+            bookmark_date = bookmarks.page_done(report_date, is_data_golden)
+            # NB: Only pages of golden days are checkpointed, the pages
+            # before it can't change if the day resumes from its token
+            if bookmark_date == report_date and is_data_golden and next_page_token:
+                page_checkpoint = {'report_date': report_date.strftime("%Y-%m-%d"),
+                                   'next_page_token': next_page_token}
+            elif bookmark_date:
+                page_checkpoint = None
+
+        if bookmark_date:
+            bookmark = {'last_report_date': bookmark_date.strftime("%Y-%m-%d")}
+            if page_checkpoint:
+                bookmark['page_checkpoint'] = page_checkpoint
+            data_last_refreshed = {day: last_refreshed
+                                   for day, last_refreshed in get_data_last_refreshed(state, report).items()
+                                   if day >= bookmark['last_report_date']}
+            if skip_unchanged_days and data_last_refreshed:
+                bookmark['data_last_refreshed'] = data_last_refreshed
+            singer.write_bookmark(state,
+                                  report["id"],
+                                  report['profile_id'],
+                                  bookmark)
+            output.write_state(state)
     LOGGER.info("Done syncing %s for view_id %s", report['name'], report['profile_id'])
+    return bookmarks
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from singer import utils
+
+from tap_google_analytics.archive import ResponseArchive, get_archived_report_pages
+from tap_google_analytics.sync import sync_report
+
+REPORT = {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": ["ga:users"], "dimensions": []}
+SCHEMA = {"type": "object", "properties": {"ga:users": {"type": ["string"]}}}
+
+def get_mock_report(name, profile_id, report_date, metrics, dimensions, page_token=None):
+    for page_number, next_page_token in enumerate(["1", None]):
+        yield {"reports": [{"columnHeader": {"metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                            "data": {"isDataGolden": report_date.day < 3,
+                                     "rows": [{"metrics": [{"values": [str(report_date.day * 10 + page_number)]}]}]},
+                            "nextPageToken": next_page_token}],
+               "profileId": profile_id,
+               "webPropertyId": "UA-1",
+               "accountId": "1",
+               "reportDate": report_date,
+               "pageToken": None if page_number == 0 else "1",
+               "metrics": metrics,
+               "dimensions": dimensions}
+
+class TestArchiveReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def sync(self, client, config, end_date="2019-11-03"):
+        records = []
+        def write_records(stream_name, page_records, time_extracted=None):
+            records.extend(page_records)
+            return len(records)
+        output = MagicMock()
+        output.write_records.side_effect = write_records
+        state = {}
+        sync_report(client, SCHEMA, REPORT,
+                    utils.strptime_to_utc("2019-11-01"), utils.strptime_to_utc(end_date),
+                    state, output=output, config=config)
+        return records, state
+
+    def test_replay_matches_the_archived_sync(self):
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=get_mock_report)
+        synced = self.sync(client, {"archive_dir": self.directory.name})
+
+        replay_client = MagicMock()
+        replayed = self.sync(replay_client, {"replay_archive_dir": self.directory.name})
+
+        self.assertEqual(6, len(synced[0]))
+        self.assertEqual(synced, replayed)
+        self.assertFalse(replay_client.method_calls)
+
+    def test_replay_stops_at_first_day_not_archived(self):
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=get_mock_report)
+        self.sync(client, {"archive_dir": self.directory.name}, end_date="2019-11-01")
+
+        records, state = self.sync(MagicMock(), {"replay_archive_dir": self.directory.name})
+
+        self.assertEqual(["10", "11"], [r["ga:users"] for r in records])
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-01'}}}}, state)
+
+    def test_interrupted_archives_are_readable(self):
+        archive = ResponseArchive(self.directory.name, REPORT)
+        for page in get_mock_report("test_report", "12345", utils.strptime_to_utc("2019-11-01"), ["ga:users"], []):
+            archive.write_page(page)
+        # NB: Simulate a crash, the file is never closed
+        with open(archive.path, 'rb') as archive_file:
+            data = archive_file.read()
+        with open(os.path.join(os.path.dirname(archive.path), "interrupted.jsonl.gz"), 'wb') as archive_file:
+            archive_file.write(data)
+        os.remove(archive.path)
+
+        pages = list(get_archived_report_pages(self.directory.name, REPORT,
+                                               utils.strptime_to_utc("2019-11-01"),
+                                               utils.strptime_to_utc("2019-11-01")))
+        self.assertEqual(["1", None], [p["reports"][0]["nextPageToken"] for _, p in pages[:2]])
+        self.assertIsNone(pages[2][1])
@@ -0,0 +1,179 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from singer import utils
+
+from tap_google_analytics.cache import ResponseCache
+from tap_google_analytics.client import Client
+
+
+def get_body(page_token=None):
+    body = {"reportRequests": [{"viewId": "12345",
+                                "dateRanges": [{"startDate": "2020-04-01", "endDate": "2020-04-01"}],
+                                "metrics": [{"expression": "ga:users"}],
+                                "dimensions": []}]}
+    if page_token:
+        body["reportRequests"][0]["pageToken"] = page_token
+    return body
+
+def get_response(is_data_golden, rows=1):
+    return {"reports": [{"data": {"isDataGolden": is_data_golden,
+                                  "rows": [{"metrics": [{"values": [str(i)]}]} for i in range(rows)]}}]}
+
+class MockResponse:
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_golden_responses_are_cached(self):
+        self.cache.put(get_body(), get_response(True))
+        self.assertEqual(get_response(True), self.cache.get(get_body()))
+        self.assertIsNone(self.cache.get(get_body(page_token="1000")))
+
+    def test_non_golden_responses_are_not_cached(self):
+        self.cache.put(get_body(), get_response(False))
+        self.assertIsNone(self.cache.get(get_body()))
+
+    def test_least_recently_used_responses_are_evicted(self):
+        self.cache.put(get_body("1"), get_response(True, rows=100))
+        self.cache.put(get_body("2"), get_response(True, rows=100))
+        file_size = max(self.cache._sizes.values())
+        for file_path, last_used in zip(sorted(self.cache._sizes, key=os.path.getmtime), (1, 2)):
+            os.utime(file_path, (last_used, last_used))
+        # Use the first response, so the second is the least recently used
+        self.cache.get(get_body("1"))
+
+        self.cache.max_size = int(file_size * 2.5)
+        self.cache.put(get_body("3"), get_response(True, rows=100))
+
+        self.assertIsNotNone(self.cache.get(get_body("1")))
+        self.assertIsNone(self.cache.get(get_body("2")))
+        self.assertIsNotNone(self.cache.get(get_body("3")))
+
+    def test_eviction_leaves_room_for_more_responses(self):
+        self.cache.put(get_body("1"), get_response(True, rows=100))
+        file_size = max(self.cache._sizes.values())
+        self.cache.max_size = int(file_size * 10.5)
+        for page in range(2, 12):
+            self.cache.put(get_body(str(page)), get_response(True, rows=100))
+
+        # Evicted down to 90%, so the next response fits without evicting again
+        self.assertEqual(9, len(self.cache._sizes))
+        with patch("os.path.getmtime") as mocked_getmtime:
+            self.cache.put(get_body("12"), get_response(True, rows=100))
+        self.assertFalse(mocked_getmtime.called)
+        self.assertEqual(sum(self.cache._sizes.values()), self.cache._total_size)
+
+    def test_cache_size_is_read_from_disk(self):
+        self.cache.put(get_body(), get_response(True))
+        self.assertEqual(self.cache._sizes, ResponseCache(self.directory.name)._sizes)
+
+
+class TestClientResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+            'response_cache_dir': self.directory.name,
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_report(self, client):
+        return list(client.get_report("report", "12345", utils.strptime_to_utc("2020-04-01"), ["ga:users"], []))
+
+    def test_golden_reports_are_requested_once(self):
+        with patch.object(Client, 'post', return_value=MockResponse(get_response(True))) as mocked_post:
+            first_pages = self.get_report(Client(self.config))
+            second_pages = self.get_report(Client(self.config))
+
+        self.assertEqual(1, mocked_post.call_count)
+        self.assertEqual(first_pages, second_pages)
+
+    def test_non_golden_reports_are_requested_every_time(self):
+        with patch.object(Client, 'post', side_effect=lambda *args: MockResponse(get_response(False))) as mocked_post:
+            self.get_report(Client(self.config))
+            self.get_report(Client(self.config))
+
+        self.assertEqual(2, mocked_post.call_count)
+
+
+class MockHttpResponse:
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class TestClientHttpCache(unittest.TestCase):
+    url = "https://www.googleapis.com/analytics/v3/metadata/ga/columns"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+            'http_cache_dir': self.directory.name,
+            'management_requests_per_second': 1000,
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_not_modified_responses_are_read_from_disk(self):
+        responses = [MockHttpResponse(200, '{"items": [1]}', {"ETag": '"abc"', "Last-Modified": "Wed, 01 Apr 2020 00:00:00 GMT"}),
+                     MockHttpResponse(304)]
+        with patch.object(Client, '_make_request', side_effect=responses) as mocked_request:
+            first_response = Client(self.config).get(self.url)
+            second_response = Client(self.config).get(self.url)
+
+        self.assertEqual({}, mocked_request.call_args_list[0][1]["headers"])
+        self.assertEqual({"If-None-Match": '"abc"', "If-Modified-Since": "Wed, 01 Apr 2020 00:00:00 GMT"},
+                         mocked_request.call_args_list[1][1]["headers"])
+        self.assertEqual(first_response.json(), second_response.json())
+
+    def test_modified_responses_replace_the_cached_one(self):
+        responses = [MockHttpResponse(200, '{"items": [1]}', {"ETag": '"abc"'}),
+                     MockHttpResponse(200, '{"items": [2]}', {"ETag": '"def"'}),
+                     MockHttpResponse(304)]
+        with patch.object(Client, '_make_request', side_effect=responses) as mocked_request:
+            for _ in range(3):
+                response = Client(self.config).get(self.url)
+
+        self.assertEqual({"If-None-Match": '"def"'}, mocked_request.call_args_list[2][1]["headers"])
+        self.assertEqual({"items": [2]}, response.json())
+
+    def test_responses_without_validators_are_not_cached(self):
+        responses = [MockHttpResponse(200, '{"items": [1]}'), MockHttpResponse(200, '{"items": [1]}')]
+        with patch.object(Client, '_make_request', side_effect=responses) as mocked_request:
+            Client(self.config).get(self.url)
+            Client(self.config).get(self.url)
+
+        self.assertEqual({}, mocked_request.call_args_list[1][1]["headers"])
@@ -1,6 +1,10 @@
 import unittest
 import requests
+import os
 import re
+import tempfile
+import threading
+import time
 import tap_google_analytics.client as GoogleAnalyticsClient
 from unittest.mock import patch
 from unittest.mock import MagicMock
@@ -8,6 +12,7 @@ from unittest.mock import MagicMock
 from tap_google_analytics.client import Client
 
 import singer
+from singer import utils
 
 LOGGER = singer.get_logger()
 
@@ -257,3 +262,212 @@ class TestClientTCPKeepalive(unittest.TestCase):
     def test_keepalive_on_session_request(self):
         client = Client(self.config, self.config_path)
         self.assertEqual(self.request_spy.call_args[1].get('headers', {}).get('Connection'), 'keep-alive')
+
+class TestGetReport(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+        }
+
+    def test_report_resumes_from_page_token(self):
+        client = Client(self.config)
+        responses = [{"reports": [{"nextPageToken": "2000"}]}, {"reports": [{}]}]
+        with patch.object(Client, 'post', side_effect=[MockResponse(r, 200) for r in responses]) as mocked_post:
+            pages = list(client.get_report("report", "12345", utils.strptime_to_utc("2020-04-01"), ["ga:users"], [], page_token="1000"))
+
+        self.assertEqual(["1000", "2000"], [p["pageToken"] for p in pages])
+        self.assertEqual(["1000", "2000"], [c[0][1]["reportRequests"][0]["pageToken"] for c in mocked_post.call_args_list])
+
+
+class TestManagementRequests(unittest.TestCase):
+    def test_get_requests_are_spaced_out(self):
+        config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+            'management_requests_per_second': 20,
+        }
+        client = Client(config)
+        request_times = []
+        with patch.object(Client, '_make_request', side_effect=lambda *args, **kwargs: request_times.append(time.monotonic())):
+            for _ in range(3):
+                client.get("https://www.googleapis.com/analytics/v3/management/accounts")
+
+        self.assertGreaterEqual(request_times[2] - request_times[0], 0.09)
+
+    def test_wildcard_collections_are_paginated(self):
+        config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+        }
+        pages = [MockResponse({"items": [{"id": "1"}, {"id": "2"}], "nextLink": "next"}, 200),
+                 MockResponse({"items": [{"id": "3"}]}, 200)]
+        with patch.object(Client, 'get', side_effect=pages) as mocked_get:
+            goals = Client(config).get_all_goals()
+
+        self.assertEqual(["1", "2", "3"], [g["id"] for g in goals])
+        self.assertEqual([1, 3], [c[1]["params"]["start-index"] for c in mocked_get.call_args_list])
+
+
+class TestProfileLookup(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_ids': ['3', '5'],
+            'account_summaries_workers': 2,
+        }
+        self.requested_pages = []
+
+    def get_account_summaries_page(self, url, params=None):
+        # 10 accounts, 2 per page, with one property and one profile each
+        start_index = params["start-index"]
+        self.requested_pages.append(start_index)
+        return MockResponse({"totalResults": 10,
+                             "items": [{"id": str(i),
+                                        "webProperties": [{"id": "UA-{}".format(i),
+                                                           "profiles": [{"id": str(i)}]}]}
+                                       for i in range(start_index, start_index + 2)]},
+                            200)
+
+    def test_crawl_stops_once_all_views_are_found(self):
+        with patch.object(Client, 'get', side_effect=self.get_account_summaries_page):
+            client = Client(self.config)
+
+        self.assertEqual({"3": {"web_property_id": "UA-3", "account_id": "3"},
+                          "5": {"web_property_id": "UA-5", "account_id": "5"}},
+                         client.profile_lookup)
+        self.assertEqual([1, 3, 5], self.requested_pages)
+
+    def test_profile_lookup_is_cached_in_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.config['profile_lookup_cache_path'] = os.path.join(directory, "profile_lookup.json")
+            with patch.object(Client, 'get', side_effect=self.get_account_summaries_page):
+                client = Client(self.config)
+                cached_client = Client(self.config)
+                self.config['profile_lookup_cache_ttl'] = -1
+                expired_client = Client(self.config)
+
+        self.assertNotIn('cached_profile_lookup', self.config)
+        self.assertEqual(client.profile_lookup, cached_client.profile_lookup)
+        self.assertEqual(client.profile_lookup, expired_client.profile_lookup)
+        self.assertEqual([1, 3, 5, 1, 3, 5], self.requested_pages)
+
+    def test_property_profiles_are_answered_from_account_summaries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.config['profile_lookup_cache_path'] = os.path.join(directory, "profile_lookup.json")
+            with patch.object(Client, 'get', side_effect=self.get_account_summaries_page) as mocked_get:
+                client = Client(self.config)
+                cached_client = Client(self.config)
+                request_count = mocked_get.call_count
+
+                self.assertEqual(["3"], client.get_profiles_for_property("3", "UA-3"))
+                self.assertEqual(["5"], cached_client.get_profiles_for_property("5", "UA-5"))
+                self.assertEqual(request_count, mocked_get.call_count)
+
+
+class TestFieldMetadataSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.directory.name, "ga_columns.json")
+        self.config = {
+            'auth_method': 'oauth2',
+            'refresh_token': 'refresh_token',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'view_id': '12345',
+            'cached_profile_lookup': '{"12345": {"web_property_id": "UA-1", "account_id": "1"}}',
+            'field_metadata_snapshot_path': self.snapshot_path,
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def join_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name == "field-metadata-refresh":
+                thread.join()
+
+    def test_snapshot_is_used_without_requests(self):
+        GoogleAnalyticsClient.write_field_metadata_snapshot(self.snapshot_path, {"etag": "1", "items": []})
+        client = Client({**self.config, 'field_metadata_source': 'snapshot'})
+        with patch.object(Client, 'get') as mocked_get:
+            field_metadata = client.get_field_metadata()
+
+        self.assertEqual({"etag": "1", "items": []}, field_metadata)
+        self.assertFalse(mocked_get.called)
+
+    def test_bundled_snapshot_is_read_from_the_package(self):
+        file_name = "ga_columns.test-{}.json".format(os.getpid())
+        package_path = os.path.join(os.path.dirname(GoogleAnalyticsClient.__file__), file_name)
+        GoogleAnalyticsClient.write_field_metadata_snapshot(package_path, {"etag": "bundled", "items": []})
+        try:
+            client = Client({**self.config, 'field_metadata_source': 'snapshot'})
+            with patch("tap_google_analytics.client.FIELD_METADATA_SNAPSHOT", file_name), \
+                 patch("pkgutil.get_data", wraps=GoogleAnalyticsClient.pkgutil.get_data) as mocked_get_data:
+                field_metadata = client.get_field_metadata()
+        finally:
+            os.remove(package_path)
+
+        self.assertEqual("bundled", field_metadata["etag"])
+        mocked_get_data.assert_called_once_with("tap_google_analytics", file_name)
+
+    def test_snapshot_is_refreshed_in_the_background(self):
+        GoogleAnalyticsClient.write_field_metadata_snapshot(self.snapshot_path, {"etag": "1", "items": []})
+        client = Client({**self.config, 'field_metadata_source': 'snapshot_refresh'})
+        with patch.object(Client, '_request', return_value=MockResponse({"etag": "2", "items": []}, 200)):
+            field_metadata = client.get_field_metadata()
+            self.join_refresh()
+
+        self.assertEqual("1", field_metadata["etag"])
+        self.assertEqual("2", client.get_field_metadata_snapshot()["etag"])
+
+    def test_failed_refresh_is_not_retried(self):
+        GoogleAnalyticsClient.write_field_metadata_snapshot(self.snapshot_path, {"etag": "1", "items": []})
+        client = Client({**self.config, 'field_metadata_source': 'snapshot_refresh'})
+        client._Client__access_token = 'token'
+        with patch.object(client.session, 'request', side_effect=requests.exceptions.ConnectionError) as mocked_request, \
+             patch.object(Client, '_ensure_access_token'):
+            client.get_field_metadata()
+            self.join_refresh()
+
+        self.assertEqual(1, mocked_request.call_count)
+        self.assertEqual(GoogleAnalyticsClient.FIELD_METADATA_REFRESH_TIMEOUT, mocked_request.call_args[1]["timeout"])
+        self.assertEqual("1", client.get_field_metadata_snapshot()["etag"])
+
+    def test_missing_snapshot_is_not_requested(self):
+        client = Client({**self.config, 'field_metadata_source': 'snapshot'})
+        with patch.object(Client, 'get_field_metadata_snapshot', return_value=None), \
+             patch.object(Client, 'get') as mocked_get:
+            with self.assertRaises(Exception):
+                client.get_field_metadata()
+
+        self.assertFalse(mocked_get.called)
+
+    def test_missing_snapshot_is_requested(self):
+        client = Client({**self.config, 'field_metadata_source': 'snapshot_refresh'})
+        with patch.object(Client, 'get_field_metadata_snapshot', return_value=None), \
+             patch.object(Client, 'get', return_value=MockResponse({"etag": "2", "items": []}, 200)) as mocked_get:
+            field_metadata = client.get_field_metadata()
+
+        self.assertEqual("2", field_metadata["etag"])
+        self.assertEqual(1, mocked_get.call_count)
+        self.assertTrue(os.path.exists(self.snapshot_path))
+
+    def test_unknown_source_is_rejected(self):
+        with self.assertRaises(Exception):
+            Client({**self.config, 'field_metadata_source': 'cache'})
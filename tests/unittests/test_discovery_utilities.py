@@ -1,10 +1,12 @@
 import datetime
+import random
+import time
 import pytz
 import unittest
 from unittest.mock import Mock, MagicMock, patch
 
 from tap_google_analytics.discover import calculate_custom_fields_support, \
-    get_custom_fields_supertypes, types_to_schema
+    get_custom_fields_supertypes, types_to_schema, discover
 
 class TestCalculateCustomFieldsSupport(unittest.TestCase):
 
@@ -218,3 +220,100 @@ class TestTypesToSchema(unittest.TestCase):
         expected = {'type': ['integer', 'string', 'null']}
 
         self.assertEqual(expected, actual)
+
+
+class MockDiscoveryClient():
+    """ Answers discovery requests for views 1-8, spread across two properties, with random latency. """
+    def __init__(self):
+        self.profile_lookup = {str(view_id): {"account_id": "1", "web_property_id": "UA-1-{}".format(view_id % 2)}
+                               for view_id in range(1, 9)}
+        self.property_requests = []
+        self.goals_requests = []
+
+    def respond(self, response):
+        time.sleep(random.random() / 100)
+        return response
+
+    def get_field_metadata(self):
+        return {"items": [{"id": "ga:users",
+                           "attributes": {"uiName": "Users", "dataType": "INTEGER", "group": "User",
+                                          "status": "PUBLIC", "type": "METRIC"}},
+                          {"id": "ga:goalXXStarts",
+                           "attributes": {"uiName": "Goal XX Starts", "dataType": "INTEGER", "group": "Goal Conversions",
+                                          "status": "PUBLIC", "type": "METRIC"}}]}
+
+    def get_raw_cubes(self):
+        return {"cube1": ["ga:users", "ga:goalXXStarts", "ga:metricXX", "ga:dimensionXX"]}
+
+    def get_custom_metrics(self, account_id, web_property_id):
+        self.property_requests.append(("customMetrics", web_property_id))
+        return self.respond({"items": [{"id": "ga:metric{}".format(web_property_id[-1]), "name": "Metric", "kind": "analytics#customMetric",
+                                        "type": "INTEGER" if web_property_id.endswith("1") else "CURRENCY"}]})
+
+    def get_custom_dimensions(self, account_id, web_property_id):
+        self.property_requests.append(("customDimensions", web_property_id))
+        return self.respond({"items": [{"id": "ga:dimension1", "name": "Dimension", "kind": "analytics#customDimension"}]})
+
+    def get_profiles_for_property(self, account_id, web_property_id):
+        self.property_requests.append(("profiles", web_property_id))
+        return self.respond([view_id for view_id, lookup in self.profile_lookup.items()
+                             if lookup["web_property_id"] == web_property_id])
+
+    def get_all_profiles(self):
+        self.property_requests.append(("profiles", "~all"))
+        # Includes profiles that aren't being discovered
+        return [{"id": view_id, "accountId": lookup["account_id"], "webPropertyId": lookup["web_property_id"]}
+                for view_id, lookup in self.profile_lookup.items()] + [{"id": "99", "accountId": "2", "webPropertyId": "UA-2-1"}]
+
+    def get_all_goals(self):
+        self.goals_requests.append("~all")
+        return [{"id": goal_id, "profileId": profile_id}
+                for profile_id in list(self.profile_lookup) + ["99"]
+                for goal_id in self.get_goals_for_profile(profile_id)]
+
+    def get_goals_for_profile(self, profile_id):
+        self.goals_requests.append(profile_id)
+        return self.respond(["1", str(profile_id)])
+
+
+class TestParallelDiscovery(unittest.TestCase):
+
+    def test_parallel_discovery_generates_the_same_catalog(self):
+        config = {"report_definitions": [{"id": "abc", "name": "custom_report"}]}
+        profile_ids = [str(view_id) for view_id in range(1, 9)]
+
+        serial_catalog = discover(MockDiscoveryClient(), config, profile_ids)
+        parallel_catalog = discover(MockDiscoveryClient(), {**config, "discovery_workers": 4}, profile_ids)
+
+        self.assertEqual(serial_catalog.to_dict(), parallel_catalog.to_dict())
+
+    def test_custom_fields_are_requested_once_per_property(self):
+        client = MockDiscoveryClient()
+        discover(client, {"discovery_workers": 4}, [str(view_id) for view_id in range(1, 9)])
+
+        self.assertEqual(sorted((request, "UA-1-{}".format(p))
+                                for request in ("customDimensions", "customMetrics", "profiles")
+                                for p in range(2)),
+                         sorted(client.property_requests))
+
+    def test_goals_are_requested_once_per_profile(self):
+        client = MockDiscoveryClient()
+        profile_ids = [str(view_id) for view_id in range(1, 9)]
+        discover(client,
+                 {"report_definitions": [{"id": "abc", "name": "custom_report"}, {"id": "def", "name": "other_report"}],
+                  "discovery_workers": 4},
+                 profile_ids)
+
+        self.assertEqual(sorted(profile_ids), sorted(client.goals_requests))
+
+    def test_bulk_discovery_generates_the_same_catalog(self):
+        config = {"report_definitions": [{"id": "abc", "name": "custom_report"}]}
+        profile_ids = [str(view_id) for view_id in range(1, 9)]
+
+        catalog = discover(MockDiscoveryClient(), config, profile_ids)
+        client = MockDiscoveryClient()
+        bulk_catalog = discover(client, {**config, "bulk_discovery": True}, profile_ids)
+
+        self.assertEqual(catalog.to_dict(), bulk_catalog.to_dict())
+        self.assertEqual([("profiles", "~all")], [r for r in client.property_requests if r[0] == "profiles"])
+        self.assertEqual("~all", client.goals_requests[0])
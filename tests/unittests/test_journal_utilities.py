@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from singer import utils
+
+from tap_google_analytics.journal import JournalClient, WorkJournal, journaled_page
+
+REPORT = {"id": "report1", "name": "Report 1", "profile_id": "12345", "metrics": ["ga:users"], "dimensions": []}
+
+
+def get_mock_report(name, profile_id, report_date, metrics, dimensions, page_token=None):
+    for page in range(int(page_token or 0), 3):
+        yield {"reports": [{"data": {"isDataGolden": True},
+                            "nextPageToken": str(page + 1) if page < 2 else None}],
+               "reportDate": report_date,
+               "pageToken": str(page) if page else None}
+
+
+class TestWorkJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal = WorkJournal(os.path.join(self.journal_dir, "journal.db"))
+        self.client = MagicMock()
+        self.client.get_report = MagicMock(side_effect=get_mock_report)
+        self.report_date = utils.strptime_to_utc("2020-04-01")
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.journal_dir)
+
+    def get_pages(self):
+        return list(JournalClient(self.client, self.journal, REPORT).get_report(
+            "Report 1", "12345", self.report_date, ["ga:users"], []))
+
+    def test_written_pages_are_returned_in_order(self):
+        self.journal.page_written(REPORT, self.report_date, None, "1", True)
+        self.journal.page_written(REPORT, self.report_date, "1", "2", True)
+
+        self.assertEqual([(None, "1", True), ("1", "2", True)],
+                         self.journal.get_written_pages(REPORT, self.report_date))
+
+    def test_changing_fields_changes_journal(self):
+        self.journal.page_written(REPORT, self.report_date, None, "1", True)
+
+        self.assertEqual([], self.journal.get_written_pages({**REPORT, "dimensions": ["ga:date"]}, self.report_date))
+
+    def test_prune_forgets_bookmarked_days(self):
+        self.journal.page_written(REPORT, self.report_date, None, None, True)
+        self.journal.prune(REPORT, utils.strptime_to_utc("2020-04-02"))
+
+        self.assertEqual([], self.journal.get_written_pages(REPORT, self.report_date))
+
+    def test_resumed_sync_keeps_journaled_days(self):
+        self.journal.start_sync(REPORT, utils.strptime_to_utc("2020-03-01"))
+        self.journal.page_written(REPORT, self.report_date, None, None, True)
+        self.journal.start_sync(REPORT, self.report_date)
+
+        self.assertEqual([(None, None, True)], self.journal.get_written_pages(REPORT, self.report_date))
+
+    def test_reset_state_forgets_journaled_days(self):
+        self.journal.start_sync(REPORT, utils.strptime_to_utc("2020-03-01"))
+        self.journal.page_written(REPORT, self.report_date, None, None, True)
+        self.journal.start_sync(REPORT, utils.strptime_to_utc("2020-02-01"))
+
+        self.assertEqual([], self.journal.get_written_pages(REPORT, self.report_date))
+        self.assertEqual(3, len(self.get_pages()))
+
+    def test_partially_written_day_resumes_from_next_page(self):
+        self.journal.page_written(REPORT, self.report_date, None, "1", True)
+
+        pages = self.get_pages()
+
+        self.assertEqual([True, False, False], [journaled_page(p) for p in pages])
+        self.assertEqual([None, "1", "2"], [p["pageToken"] for p in pages])
+        self.assertEqual("1", self.client.get_report.call_args[1]["page_token"])
+
+    def test_fully_written_day_is_not_requested(self):
+        for page_token, next_page_token in [(None, "1"), ("1", "2"), ("2", None)]:
+            self.journal.page_written(REPORT, self.report_date, page_token, next_page_token, True)
+
+        pages = self.get_pages()
+
+        self.assertEqual([True, True, True], [journaled_page(p) for p in pages])
+        self.assertFalse(self.client.get_report.called)
+
+    def test_days_that_are_not_golden_are_requested_again(self):
+        self.journal.page_written(REPORT, self.report_date, None, "1", False)
+
+        pages = self.get_pages()
+
+        self.assertEqual([False, False, False], [journaled_page(p) for p in pages])
+        self.assertEqual([], self.journal.get_written_pages(REPORT, self.report_date))
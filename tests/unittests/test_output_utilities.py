@@ -0,0 +1,313 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+
+from singer import utils
+
+import tap_google_analytics.output
+
+from tap_google_analytics.output import (BatchOutput, CoalescedStateOutput, ParquetOutput, QueuedOutput, SingerOutput,
+                                         dumps, get_output)
+
+
+class TestDumps(unittest.TestCase):
+
+    def test_dumps_is_compact_json(self):
+        self.assertEqual('{"a":1,"b":[null,"x"]}', dumps({"a": 1, "b": [None, "x"]}))
+
+    def test_dumps_falls_back_for_decimals(self):
+        self.assertEqual('{"a":1.10}', dumps({"a": Decimal("1.10")}))
+
+    @patch("tap_google_analytics.output.orjson", None)
+    def test_dumps_without_orjson(self):
+        self.assertEqual('{"a":1,"b":"c"}', dumps({"a": 1, "b": "c"}))
+
+
+class TestSingerOutput(unittest.TestCase):
+
+    def test_messages_are_valid_singer(self):
+        stream = io.StringIO()
+        output = SingerOutput(stream=stream)
+        time_extracted = utils.strptime_to_utc("2019-11-01T10:00:00Z")
+
+        output.write_schema("report", {"type": "object"}, ["_sdc_record_hash"])
+        count = output.write_records("report", [{"id": 1}, {"id": 2}], time_extracted=time_extracted)
+        output.write_state({"bookmarks": {}})
+        output.flush()
+
+        self.assertEqual(2, count)
+        messages = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([{"type": "SCHEMA", "stream": "report", "schema": {"type": "object"},
+                           "key_properties": ["_sdc_record_hash"]},
+                          {"type": "RECORD", "stream": "report", "record": {"id": 1},
+                           "time_extracted": "2019-11-01T10:00:00.000000Z"},
+                          {"type": "RECORD", "stream": "report", "record": {"id": 2},
+                           "time_extracted": "2019-11-01T10:00:00.000000Z"},
+                          {"type": "STATE", "value": {"bookmarks": {}}}],
+                         messages)
+
+    def test_output_is_buffered_until_flush(self):
+        stream = io.StringIO()
+        output = SingerOutput(stream=stream)
+
+        output.write_records("report", [{"id": 1}])
+        self.assertEqual("", stream.getvalue())
+
+        output.flush()
+        self.assertEqual('{"type":"RECORD","stream":"report","record":{"id":1}}\n', stream.getvalue())
+
+    def test_output_is_written_once_buffer_is_full(self):
+        stream = io.StringIO()
+        output = SingerOutput(buffer_size=10, stream=stream)
+
+        output.write_records("report", [{"id": 1}])
+
+        self.assertEqual('{"type":"RECORD","stream":"report","record":{"id":1}}\n', stream.getvalue())
+
+    def test_state_is_encoded_when_written(self):
+        stream = io.StringIO()
+        output = SingerOutput(stream=stream)
+        state = {"bookmarks": {"a": 1}}
+
+        output.write_state(state)
+        state["bookmarks"]["a"] = 2
+        output.flush()
+
+        self.assertEqual({"type": "STATE", "value": {"bookmarks": {"a": 1}}}, json.loads(stream.getvalue()))
+
+
+class TestQueuedOutput(unittest.TestCase):
+
+    def test_messages_are_written_in_order(self):
+        stream = io.StringIO()
+        output = QueuedOutput(SingerOutput(stream=stream), max_queued=1)
+        state = {"bookmarks": {"report": "2019-11-01"}}
+
+        self.assertEqual(2, output.write_records("report", iter([{"id": 1}, {"id": 2}])))
+        output.write_state(state)
+        state["bookmarks"]["report"] = "2019-11-02"
+        output.write_records("report", [{"id": 3}])
+        output.write_state(state)
+        output.close()
+
+        messages = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([{"type": "RECORD", "stream": "report", "record": {"id": 1}},
+                          {"type": "RECORD", "stream": "report", "record": {"id": 2}},
+                          {"type": "STATE", "value": {"bookmarks": {"report": "2019-11-01"}}},
+                          {"type": "RECORD", "stream": "report", "record": {"id": 3}},
+                          {"type": "STATE", "value": {"bookmarks": {"report": "2019-11-02"}}}],
+                         messages)
+
+    def test_writer_errors_are_raised_to_the_producer(self):
+        inner = MagicMock()
+        inner.write_records.side_effect = BrokenPipeError()
+        output = QueuedOutput(inner, max_queued=1)
+
+        output.write_records("report", [{"id": 1}])
+        with self.assertRaises(Exception):
+            output.flush()
+        with self.assertRaises(Exception):
+            output.write_state({})
+
+
+class TestCoalescedStateOutput(unittest.TestCase):
+
+    def get_messages(self, stream):
+        return [(m["type"], m.get("record", m.get("value"))) for m in map(json.loads, stream.getvalue().splitlines())]
+
+    def test_states_are_coalesced_per_record_interval(self):
+        stream = io.StringIO()
+        output = CoalescedStateOutput(SingerOutput(stream=stream), interval_records=2)
+        state = {"currently_syncing": "report", "bookmarks": {}}
+        output.write_state(state)
+        for day in range(1, 4):
+            output.write_records("report", [{"id": day}])
+            state["bookmarks"]["report"] = day
+            output.write_state(state)
+        output.close()
+
+        self.assertEqual([("STATE", {"currently_syncing": "report", "bookmarks": {}}),
+                          ("RECORD", {"id": 1}),
+                          ("RECORD", {"id": 2}),
+                          ("STATE", {"currently_syncing": "report", "bookmarks": {"report": 2}}),
+                          ("RECORD", {"id": 3}),
+                          ("STATE", {"currently_syncing": "report", "bookmarks": {"report": 3}})],
+                         self.get_messages(stream))
+
+    def test_states_are_written_when_view_changes(self):
+        stream = io.StringIO()
+        output = CoalescedStateOutput(SingerOutput(stream=stream), interval_seconds=3600)
+        state = {"currently_syncing": "report", "currently_syncing_view": "1"}
+        output.write_state(state)
+        output.write_records("report", [{"id": 1}])
+        state["bookmarks"] = {"report": {"1": "2019-11-01"}}
+        output.write_state(state)
+        state["currently_syncing_view"] = "2"
+        output.write_state(state)
+        output.flush()
+
+        self.assertEqual(["STATE", "RECORD", "STATE"], [t for t, _ in self.get_messages(stream)])
+        self.assertEqual({"report": {"1": "2019-11-01"}}, self.get_messages(stream)[-1][1]["bookmarks"])
+
+    def test_sync_writes_records_but_holds_state(self):
+        stream = io.StringIO()
+        output = QueuedOutput(CoalescedStateOutput(SingerOutput(stream=stream), interval_records=100), max_queued=1)
+        state = {"currently_syncing": "report"}
+        output.write_state(state)
+        output.write_records("report", [{"id": 1}])
+        state["bookmarks"] = {"report": 1}
+        output.write_state(state)
+        output.sync()
+
+        self.assertEqual(["STATE", "RECORD"], [t for t, _ in self.get_messages(stream)])
+        output.close()
+
+
+class TestGetOutput(unittest.TestCase):
+
+    def test_default_output_is_unthreaded(self):
+        self.assertIsInstance(get_output({}), SingerOutput)
+
+    def test_queue_size_enables_writer_thread(self):
+        output = get_output({"output_queue_size": "10"})
+        self.assertIsInstance(output, QueuedOutput)
+        output.close()
+
+    def test_state_interval_coalesces_states(self):
+        output = get_output({"state_interval_seconds": "30"})
+        self.assertIsInstance(output, CoalescedStateOutput)
+        self.assertEqual(30, output.interval_seconds)
+
+
+class TestBatchOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.batch_dir = tempfile.mkdtemp()
+        self.stream = io.StringIO()
+        self.output = BatchOutput(SingerOutput(stream=self.stream), self.batch_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.batch_dir)
+
+    def get_messages(self):
+        self.output.flush()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_one_batch_per_view_and_day(self):
+        self.output.write_records("Audience Overview", [{"profile_id": "1", "start_date": "2019-11-01T00:00:00.000000Z", "id": 1},
+                                                        {"profile_id": "1", "start_date": "2019-11-01T00:00:00.000000Z", "id": 2}])
+        self.output.write_records("Audience Overview", [{"profile_id": "1", "start_date": "2019-11-02T00:00:00.000000Z", "id": 3}])
+
+        messages = self.get_messages()
+
+        self.assertEqual(["BATCH", "BATCH"], [m["type"] for m in messages])
+        self.assertEqual({"format": "jsonl", "compression": "gzip"}, messages[0]["encoding"])
+        paths = [m["manifest"][0][len("file://"):] for m in messages]
+        self.assertTrue(os.path.basename(paths[0]).startswith("Audience_Overview-1-2019-11-01-"))
+        with gzip.open(paths[0], 'rt') as batch_file:
+            self.assertEqual([1, 2], [json.loads(line)["id"] for line in batch_file])
+        with gzip.open(paths[1], 'rt') as batch_file:
+            self.assertEqual([3], [json.loads(line)["id"] for line in batch_file])
+
+    def test_state_is_held_until_batch_is_written(self):
+        state = {"bookmarks": {"report": "2019-11-01"}}
+        self.output.write_state(state)
+        self.output.write_records("report", [{"profile_id": "1", "start_date": "2019-11-01", "id": 1}])
+        self.output.write_state(state)
+        state["bookmarks"]["report"] = "2019-11-02"
+
+        messages = self.get_messages()
+
+        self.assertEqual(["STATE", "BATCH", "STATE"], [m["type"] for m in messages])
+        self.assertEqual({"bookmarks": {"report": "2019-11-01"}}, messages[2]["value"])
+
+    def test_sync_keeps_the_batch_open(self):
+        self.output.write_records("report", [{"profile_id": "1", "start_date": "2019-11-01", "id": 1}])
+        self.output.sync()
+        self.output.write_records("report", [{"profile_id": "1", "start_date": "2019-11-01", "id": 2}])
+
+        self.assertEqual(["BATCH"], [m["type"] for m in self.get_messages()])
+
+    def test_get_output_rejects_journal_and_row_index(self):
+        for option in ("journal_path", "row_index_path"):
+            with self.assertRaises(Exception):
+                get_output({"output_mode": "batch", "output_dir": self.batch_dir, option: "sync.db"})
+
+    def test_get_output_requires_output_dir(self):
+        with self.assertRaises(Exception):
+            get_output({"output_mode": "batch"})
+        self.assertIsInstance(get_output({"output_mode": "batch", "output_dir": self.batch_dir}), BatchOutput)
+
+
+@unittest.skipIf(tap_google_analytics.output.pyarrow is None, "pyarrow is not installed")
+class TestParquetOutput(unittest.TestCase):
+
+    schema = {"type": "object",
+              "properties": {"_sdc_record_hash": {"type": "string"},
+                             "start_date": {"type": "string", "format": "date-time"},
+                             "end_date": {"type": "string", "format": "date-time"},
+                             "profile_id": {"type": "string"},
+                             "ga:users": {"type": ["integer", "null"]},
+                             "ga:bounceRate": {"type": ["number", "null"]},
+                             "ga:visitCount": {"type": ["integer", "string", "null"]},
+                             "ga:unselected": {"type": ["string", "null"]}}}
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.stream = io.StringIO()
+        self.output = ParquetOutput(SingerOutput(stream=self.stream), self.output_dir, row_group_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def make_record(self, day, users):
+        return {"_sdc_record_hash": "hash{}".format(users),
+                "start_date": "2019-11-0{}T00:00:00.000000Z".format(day),
+                "end_date": "2019-11-0{}T00:00:00.000000Z".format(day),
+                "profile_id": "123",
+                "ga:users": users,
+                "ga:bounceRate": 0.5,
+                "ga:visitCount": 3}
+
+    def test_files_are_partitioned_and_typed(self):
+        import pyarrow
+        import pyarrow.parquet
+        self.output.write_schema("Audience Overview", self.schema, ["_sdc_record_hash"])
+        self.output.write_records("Audience Overview", [self.make_record(1, i) for i in range(3)])
+        self.output.write_records("Audience Overview", [self.make_record(2, 4)])
+        self.output.flush()
+
+        stream_dir = os.path.join(self.output_dir, "Audience_Overview", "profile_id=123")
+        self.assertEqual(["start_date=2019-11-01", "start_date=2019-11-02"], sorted(os.listdir(stream_dir)))
+        [file_name] = os.listdir(os.path.join(stream_dir, "start_date=2019-11-01"))
+        parquet_file = pyarrow.parquet.ParquetFile(os.path.join(stream_dir, "start_date=2019-11-01", file_name))
+
+        self.assertEqual(2, parquet_file.metadata.num_row_groups)
+        self.assertEqual(pyarrow.schema([("_sdc_record_hash", pyarrow.string()),
+                                         ("end_date", pyarrow.timestamp("us", tz="UTC")),
+                                         ("ga:users", pyarrow.int64()),
+                                         ("ga:bounceRate", pyarrow.float64()),
+                                         ("ga:visitCount", pyarrow.string())]),
+                         parquet_file.schema_arrow)
+        self.assertEqual([0, 1, 2], parquet_file.read().column("ga:users").to_pylist())
+
+    def test_state_is_held_until_file_is_committed(self):
+        self.output.write_schema("report", self.schema, ["_sdc_record_hash"])
+        self.output.write_records("report", [self.make_record(1, 1)])
+        self.output.write_state({"bookmarks": {"report": "2019-11-01"}})
+
+        self.assertEqual("", self.stream.getvalue())
+        partition_dir = os.path.join(self.output_dir, "report", "profile_id=123", "start_date=2019-11-01")
+        self.assertEqual([], [f for f in os.listdir(partition_dir) if f.endswith(".parquet")])
+
+        self.output.flush()
+
+        self.assertEqual([{"type": "STATE", "value": {"bookmarks": {"report": "2019-11-01"}}}],
+                         [json.loads(line) for line in self.stream.getvalue().splitlines()])
+        self.assertEqual(1, len([f for f in os.listdir(partition_dir) if f.endswith(".parquet")]))
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from singer import utils
+
+from tap_google_analytics.row_index import RowDigestIndex
+from tap_google_analytics.sync import sync_report
+
+REPORT = {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": ["ga:users"], "dimensions": ["ga:source"]}
+SCHEMA = {"type": "object", "properties": {"ga:source": {"type": ["string"]}, "ga:users": {"type": ["string"]}}}
+
+class TestRowDigestIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {"row_index_path": os.path.join(self.directory.name, "rows.db")}
+        self.rows = {"google": "1", "bing": "2"}
+        self.is_data_golden = False
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_report(self, name, profile_id, report_date, metrics, dimensions):
+        yield {"reports": [{"columnHeader": {"dimensions": ["ga:source"],
+                                             "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                            "data": {"isDataGolden": self.is_data_golden,
+                                     "rows": [{"dimensions": [source], "metrics": [{"values": [users]}]}
+                                              for source, users in self.rows.items()]}}],
+               "profileId": profile_id,
+               "webPropertyId": "UA-1",
+               "accountId": "1",
+               "reportDate": report_date}
+
+    def sync(self, start_date="2019-11-01"):
+        records = []
+        def write_records(stream_name, page_records, time_extracted=None):
+            records.extend(page_records)
+            return len(records)
+        output = MagicMock()
+        output.write_records.side_effect = write_records
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=self.get_report)
+        sync_report(client, SCHEMA, REPORT,
+                    utils.strptime_to_utc(start_date), utils.strptime_to_utc("2019-11-01"),
+                    {}, output=output, config=self.config)
+        self.records = records
+        return {r["ga:source"]: r["ga:users"] for r in records}
+
+    def test_only_new_and_changed_rows_are_written_again(self):
+        self.assertEqual({"google": "1", "bing": "2"}, self.sync())
+        self.assertEqual({}, self.sync())
+
+        self.rows = {"google": "1", "bing": "3", "yahoo": "4"}
+        self.assertEqual({"bing": "3", "yahoo": "4"}, self.sync())
+
+    def test_golden_days_are_pruned(self):
+        self.sync()
+        self.is_data_golden = True
+        self.rows["bing"] = "3"
+        self.assertEqual({"bing": "3"}, self.sync())
+
+        index = RowDigestIndex(self.config["row_index_path"], REPORT)
+        self.assertEqual({}, index._get_day_digests(utils.strptime_to_utc("2019-11-01")))
+        index.close()
+
+    def test_reset_state_writes_all_rows_again(self):
+        self.sync(start_date="2019-10-31")
+        self.assertEqual({}, self.sync())
+
+        self.sync(start_date="2019-10-31")
+        # Both days' rows, not only those of the day pruned from the index
+        self.assertEqual(4, len(self.records))
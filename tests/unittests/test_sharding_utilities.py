@@ -0,0 +1,102 @@
+import copy
+import queue
+import unittest
+from unittest.mock import MagicMock, patch
+
+from singer import utils
+
+from tap_google_analytics.sharding import ProcessOutput, merge_view_bookmarks, sync_reports_in_processes
+
+
+def get_mock_report(name, profile_id, report_date, metrics, dimensions):
+    return iter([{"reports": [{"columnHeader": {"metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                               "data": {"isDataGolden": True,
+                                        "rows": [{"metrics": [{"values": ["1"]}]}]}}],
+                  "profileId": profile_id,
+                  "webPropertyId": "UA-1",
+                  "accountId": "1",
+                  "reportDate": report_date}])
+
+
+def mock_client(config):
+    client = MagicMock()
+    client.get_report = MagicMock(side_effect=get_mock_report)
+    return client
+
+
+class TestProcessOutput(unittest.TestCase):
+
+    def test_only_stream_bookmarks_are_sent(self):
+        messages = queue.Queue()
+        output = ProcessOutput(messages, "report1")
+        output.view_id = "12345"
+
+        self.assertEqual(2, output.write_records("Report 1", iter([{"id": 1}, {"id": 2}])))
+        output.write_state({"currently_syncing": "report1",
+                            "bookmarks": {"report1": {"12345": {"last_report_date": "2020-04-01"},
+                                                      "67890": {"last_report_date": "2020-01-01"}}}})
+
+        self.assertEqual(("records", ("Report 1", [{"id": 1}, {"id": 2}], None)), messages.get_nowait())
+        self.assertEqual(("bookmarks", ("report1", {"12345": {"last_report_date": "2020-04-01"}})), messages.get_nowait())
+
+
+class TestMergeViewBookmarks(unittest.TestCase):
+
+    def test_views_are_merged(self):
+        state = {"bookmarks": {"report1": {"12345": {"last_report_date": "2020-04-01"}}}}
+
+        actual = merge_view_bookmarks(state, "report1", {"67890": {"last_report_date": "2020-04-02"}})
+
+        expected = {"bookmarks": {"report1": {"12345": {"last_report_date": "2020-04-01"},
+                                              "67890": {"last_report_date": "2020-04-02"}}}}
+        self.assertEqual(expected, actual)
+
+
+@patch("tap_google_analytics.sharding.MULTIPROCESSING_CONTEXT", "fork")
+@patch("tap_google_analytics.sharding.Client", side_effect=mock_client)
+class TestSyncReportsInProcesses(unittest.TestCase):
+
+    def make_reports(self, view_ids):
+        return [({"id": "report1", "name": "Report 1", "profile_id": view_id, "metrics": ["ga:users"], "dimensions": []},
+                 True,
+                 utils.strptime_to_utc("2020-04-01"))
+                for view_id in view_ids]
+
+    def test_records_and_bookmarks_from_all_views(self, *args):
+        output = MagicMock()
+        output.write_records.side_effect = lambda stream, records, time_extracted: len(records)
+
+        state = sync_reports_in_processes({}, {}, self.make_reports(["1", "2", "3"]),
+                                          utils.strptime_to_utc("2020-04-02"), {}, output, 2)
+
+        self.assertEqual({"bookmarks": {"report1": {view_id: {"last_report_date": "2020-04-02"}
+                                                    for view_id in ["1", "2", "3"]}}},
+                         state)
+        self.assertEqual(6, output.write_records.call_count)
+        self.assertEqual({"1", "2", "3"},
+                         {c[0][1][0]["profile_id"] for c in output.write_records.call_args_list})
+
+    def test_existing_bookmarks_never_go_backwards(self, *args):
+        output = MagicMock()
+        output.write_records.side_effect = lambda stream, records, time_extracted: len(records)
+        written_states = []
+        output.write_state.side_effect = lambda state: written_states.append(copy.deepcopy(state))
+        state = {"bookmarks": {"report1": {view_id: {"last_report_date": "2020-01-01"}
+                                           for view_id in ["1", "2", "3", "4"]}}}
+
+        state = sync_reports_in_processes({}, {}, self.make_reports(["1", "2", "3", "4"]),
+                                          utils.strptime_to_utc("2020-04-02"), state, output, 2)
+
+        self.assertEqual({"bookmarks": {"report1": {view_id: {"last_report_date": "2020-04-02"}
+                                                    for view_id in ["1", "2", "3", "4"]}}},
+                         state)
+        for previous_state, written_state in zip(written_states, written_states[1:]):
+            for view_id, bookmark in written_state["bookmarks"]["report1"].items():
+                self.assertGreaterEqual(bookmark["last_report_date"],
+                                        previous_state["bookmarks"]["report1"][view_id]["last_report_date"])
+
+    def test_process_errors_are_raised(self, mocked_client):
+        mocked_client.side_effect = Exception("No client!")
+        with self.assertRaises(Exception):
+            sync_reports_in_processes({}, {}, self.make_reports(["1"]),
+                                      utils.strptime_to_utc("2020-04-02"), {}, MagicMock(), 2)
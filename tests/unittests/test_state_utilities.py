@@ -1,9 +1,12 @@
+import copy
 import datetime
+import json
 import pytz
 import unittest
 from unittest.mock import Mock, MagicMock, patch
 
 from tap_google_analytics import clean_state_for_report, get_start_date
+from tap_google_analytics.state import compact_state, expand_state
 
 class TestCleanStateForReport(unittest.TestCase):
 
@@ -164,3 +167,65 @@ class TestGetStartDate(unittest.TestCase):
         expected = (True, datetime.datetime(2020, 3, 15, tzinfo=pytz.utc))
 
         self.assertEqual(expected, actual)
+
+
+class TestCompactState(unittest.TestCase):
+    def setUp(self):
+        self.state = {
+            'currently_syncing': 'report1',
+            'bookmarks': {
+                'report1': {str(view_id): {'last_report_date': '2020-04-0{}'.format(view_id % 2 + 1)}
+                            for view_id in range(2000)}
+            }
+        }
+        self.state['bookmarks']['report1']['13579'] = {
+            'last_report_date': '2020-04-01',
+            'page_checkpoint': {'report_date': '2020-04-01', 'next_page_token': '1000'}
+        }
+
+    def test_views_are_grouped_by_date(self):
+        compacted = compact_state(self.state)
+
+        self.assertEqual(2, compacted['state_version'])
+        self.assertEqual(['2020-04-01', '2020-04-02'],
+                         sorted(compacted['bookmarks']['report1']['last_report_dates']))
+        self.assertEqual(self.state['bookmarks']['report1']['13579'],
+                         compacted['bookmarks']['report1']['13579'])
+        self.assertLess(len(json.dumps(compacted)) * 3, len(json.dumps(self.state)))
+
+    def test_views_on_the_same_date_are_runs(self):
+        state = {'bookmarks': {'report{}'.format(stream): {str(view_id): {'last_report_date': '2020-04-01'}
+                                                           for view_id in range(100000, 102000)}
+                               for stream in range(20)}}
+        compacted = compact_state(state)
+
+        self.assertEqual({'2020-04-01': '0-1999'}, compacted['bookmarks']['report0']['last_report_dates'])
+        self.assertLess(len(json.dumps(compacted)) * 50, len(json.dumps(state)))
+
+    def test_compact_state_expands_to_the_same_state(self):
+        expected = copy.deepcopy(self.state)
+        self.assertEqual(expected, expand_state(json.loads(json.dumps(compact_state(self.state)))))
+        self.assertEqual(expected, self.state)
+
+    def test_bookmarks_of_a_view_are_grouped_per_stream(self):
+        state = {'bookmarks': {'report1': {'12345': {'last_report_date': '2020-04-01'}},
+                               'report2': {'12345': {'last_report_date': '2020-04-01',
+                                                     'page_checkpoint': {'report_date': '2020-04-01',
+                                                                         'next_page_token': '1000'}}},
+                               'report3': {'12345': {'data_last_refreshed': {'2020-04-02': '2020-04-03T00:00:00Z'}}}}}
+        expected = copy.deepcopy(state)
+
+        compacted = compact_state(state)
+
+        self.assertEqual({'last_report_dates': {'2020-04-01': '0'}}, compacted['bookmarks']['report1'])
+        self.assertEqual(state['bookmarks']['report2'], compacted['bookmarks']['report2'])
+        self.assertEqual(state['bookmarks']['report3'], compacted['bookmarks']['report3'])
+        self.assertEqual(expected, expand_state(json.loads(json.dumps(compacted))))
+
+    def test_regular_state_is_unchanged(self):
+        expected = copy.deepcopy(self.state)
+        self.assertEqual(expected, expand_state(self.state))
+
+    def test_unknown_state_version_is_rejected(self):
+        with self.assertRaises(Exception):
+            expand_state({'state_version': 3, 'bookmarks': {}})
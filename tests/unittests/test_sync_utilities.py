@@ -1,9 +1,12 @@
+import copy
 import unittest
 from unittest.mock import Mock, MagicMock, patch
+import singer
 from singer import utils
 
 import tap_google_analytics.sync
-from tap_google_analytics.sync import sync_report, generate_sdc_record_hash
+from tap_google_analytics import sync_messages
+from tap_google_analytics.sync import BookmarkTracker, sync_report, generate_sdc_record_hash, get_daily_reports
 
 # Test State Tracking Globals
 reports = None
@@ -149,3 +152,307 @@ class TestRecordHashing(unittest.TestCase):
 
         expected_hash = 'f107fb927002d0cbf257bd53c1a5d88bcb80e4e796f1812cf501107cf1f1544b'
         self.assertEqual(expected_hash, generate_sdc_record_hash(test_report, row, report_start, report_end))
+
+
+def mock_do_sync(client, config, catalog, state, output):
+    output.write_schema("test_report", {"type": "object"}, ["_sdc_record_hash"])
+    output.write_records("test_report", iter([{"id": 1}, {"id": 2}]), time_extracted=utils.now())
+    state["bookmarks"] = {"test_report": {"12345": {"last_report_date": "2019-11-01"}}}
+    output.write_state(state)
+    if config.get("fail"):
+        raise ValueError("Sync failed!")
+    state["bookmarks"]["test_report"]["12345"]["last_report_date"] = "2019-11-02"
+
+
+class TestSyncMessages(unittest.TestCase):
+
+    @patch("tap_google_analytics.do_sync", side_effect=mock_do_sync)
+    def test_messages_are_yielded_as_objects(self, *args):
+        messages = list(sync_messages(MagicMock(), {}, MagicMock(), {}))
+
+        self.assertEqual([singer.SchemaMessage, singer.RecordMessage, singer.RecordMessage, singer.StateMessage],
+                         [type(m) for m in messages])
+        self.assertEqual([{"id": 1}, {"id": 2}], [m.record for m in messages[1:3]])
+        # State is a snapshot taken when it was written
+        self.assertEqual({"bookmarks": {"test_report": {"12345": {"last_report_date": "2019-11-01"}}}},
+                         messages[3].value)
+
+    @patch("tap_google_analytics.do_sync", side_effect=mock_do_sync)
+    def test_sync_errors_are_raised(self, *args):
+        messages = sync_messages(MagicMock(), {"fail": True}, MagicMock(), {})
+        with self.assertRaises(ValueError):
+            list(messages)
+
+    @patch("tap_google_analytics.do_sync", side_effect=mock_do_sync)
+    def test_stopping_early_cancels_sync(self, *args):
+        messages = sync_messages(MagicMock(), {}, MagicMock(), {}, max_queued=1)
+        next(messages)
+        messages.close()
+
+
+class TestPrefetching(unittest.TestCase):
+    report = {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": [], "dimensions": []}
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.get_report = MagicMock(side_effect=lambda name, profile_id, report_date, metrics, dimensions:
+                                           iter([(report_date.day, 1), (report_date.day, 2)]))
+
+    def get_pages(self, **kwargs):
+        return [(report_date.day, list(pages))
+                for report_date, pages in get_daily_reports(self.client,
+                                                            self.report,
+                                                            utils.strptime_to_utc("2019-11-01"),
+                                                            utils.strptime_to_utc("2019-11-05"),
+                                                            **kwargs)]
+
+    def test_prefetched_pages_are_in_order(self):
+        expected = [(day, [(day, 1), (day, 2)]) for day in range(1, 6)]
+        self.assertEqual(expected, self.get_pages())
+        self.assertEqual(expected, self.get_pages(prefetch_days=3, prefetch_pages=1))
+
+    def test_prefetch_errors_are_raised_for_their_day(self):
+        def get_report(name, profile_id, report_date, metrics, dimensions):
+            if report_date.day == 3:
+                raise Exception("Report failed!")
+            return iter([report_date.day])
+        self.client.get_report = MagicMock(side_effect=get_report)
+
+        daily_reports = get_daily_reports(self.client,
+                                          self.report,
+                                          utils.strptime_to_utc("2019-11-01"),
+                                          utils.strptime_to_utc("2019-11-05"),
+                                          prefetch_days=2)
+        self.assertEqual([1], list(next(daily_reports)[1]))
+        self.assertEqual([2], list(next(daily_reports)[1]))
+        with self.assertRaises(Exception):
+            list(next(daily_reports)[1])
+        daily_reports.close()
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_bookmarking_is_unchanged_when_prefetching(self, *args):
+        golden = {1: True, 2: True, 3: None, 4: True}
+        self.client.get_report = MagicMock(side_effect=lambda name, profile_id, report_date, metrics, dimensions:
+                                           iter([{"reports": [{"data": {"isDataGolden": golden[report_date.day]}}]}]))
+        state = {}
+        sync_report(self.client,
+                    {},
+                    self.report,
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-04"),
+                    state,
+                    config={"prefetch_days": 2})
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
+
+
+class TestBookmarkTracker(unittest.TestCase):
+    days = [utils.strptime_to_utc("2019-11-0{}".format(day)) for day in range(1, 5)]
+
+    def test_days_finishing_out_of_order_wait_for_earlier_days(self):
+        tracker = BookmarkTracker(self.days)
+
+        self.assertIsNone(tracker.page_done(self.days[1], True))
+        self.assertIsNone(tracker.day_done(self.days[1]))
+        self.assertIsNone(tracker.page_done(self.days[2], True))
+
+        # Day 1 completes the prefix through day 2, and day 3's finished page
+        self.assertEqual(self.days[0], tracker.page_done(self.days[0], True))
+        self.assertEqual(self.days[2], tracker.day_done(self.days[0]))
+
+    def test_bookmarking_stops_at_first_non_golden_day(self):
+        tracker = BookmarkTracker(self.days)
+        for day, is_data_golden in zip(reversed(self.days), [True, None, True, True]):
+            tracker.page_done(day, is_data_golden)
+            if day != self.days[0]:
+                tracker.day_done(day)
+
+        self.assertEqual(self.days[2], tracker.day_done(self.days[0]))
+        self.assertFalse(tracker.all_data_golden)
+
+    def test_first_day_goldenness_is_recorded(self):
+        tracker = BookmarkTracker(self.days, historically_syncing=True)
+        # Pages of later days are held until the first day's
+        tracker.page_done(self.days[1], True)
+        self.assertIsNone(tracker.first_day_golden)
+
+        tracker.page_done(self.days[0], None)
+        tracker.day_done(self.days[0])
+
+        self.assertFalse(tracker.first_day_golden)
+        self.assertFalse(tracker.historically_syncing)
+
+
+class TestParallelDays(unittest.TestCase):
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    def test_bookmarks_are_committed_in_order(self, *args):
+        golden = {1: True, 2: True, 3: None, 4: True}
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=lambda name, profile_id, report_date, metrics, dimensions:
+                                      iter([{"reports": [{"data": {"isDataGolden": golden[report_date.day]}}]}] * 2))
+        output = MagicMock()
+        output.write_records.return_value = 0
+        bookmarks = []
+        output.write_state.side_effect = lambda state: bookmarks.append(state['bookmarks']['123']['12345']['last_report_date'])
+
+        state = {}
+        sync_report(client,
+                    {},
+                    {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": [], "dimensions": []},
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-04"),
+                    state,
+                    output=output,
+                    config={"parallel_days": 4, "prefetch_pages": 1})
+
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
+        self.assertEqual(sorted(bookmarks), bookmarks)
+        self.assertEqual(8, output.write_records.call_count)
+
+
+class TestPageCheckpoints(unittest.TestCase):
+    report = {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": [], "dimensions": []}
+
+    def get_pages(self, next_page_tokens, fail_after=None):
+        pages = [{"reports": [{"data": {"isDataGolden": True}, "nextPageToken": token}]}
+                 for token in next_page_tokens]
+        for page_number, page in enumerate(pages):
+            if page_number == fail_after:
+                raise Exception("Report failed!")
+            yield page
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_failed_day_leaves_a_page_checkpoint(self, *args):
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=lambda *args: self.get_pages(["1", "2", None], fail_after=2))
+        state = {}
+        with self.assertRaises(Exception):
+            sync_report(client,
+                        {},
+                        self.report,
+                        utils.strptime_to_utc("2019-11-01"),
+                        utils.strptime_to_utc("2019-11-02"),
+                        state)
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-01',
+                                                          'page_checkpoint': {'report_date': '2019-11-01',
+                                                                              'next_page_token': '2'}}}}},
+                         state)
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_sync_resumes_from_page_checkpoint(self, *args):
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=lambda *args, **kwargs: self.get_pages([None]))
+        state = {'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-01',
+                                                 'page_checkpoint': {'report_date': '2019-11-01',
+                                                                     'next_page_token': '2'}}}}}
+        sync_report(client,
+                    {},
+                    self.report,
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-02"),
+                    state)
+
+        self.assertEqual("2", client.get_report.call_args_list[0][1]["page_token"])
+        self.assertEqual({}, client.get_report.call_args_list[1][1])
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-02'}}}}, state)
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_page_checkpoint_is_dropped_when_day_completes(self, *args):
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=lambda *args: self.get_pages(["1", None]))
+        state = {}
+        sync_report(client,
+                    {},
+                    self.report,
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-01"),
+                    state)
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-01'}}}}, state)
+
+
+class TestUnchangedDays(unittest.TestCase):
+    report = {"id": "123", "name": "test_report", "profile_id": "12345", "metrics": [], "dimensions": []}
+
+    def setUp(self):
+        self.last_refreshed = {1: "2019-11-02T00:00:00Z", 2: "2019-11-03T00:00:00Z", 3: "2019-11-03T00:00:00Z"}
+        self.requested_pages = []
+        self.client = MagicMock()
+        self.client.get_report = MagicMock(side_effect=self.get_report)
+
+    def get_report(self, name, profile_id, report_date, metrics, dimensions, page_token=None):
+        for next_page_token in ["1", None]:
+            self.requested_pages.append(report_date.day)
+            yield {"reports": [{"data": {"isDataGolden": report_date.day == 1,
+                                         "dataLastRefreshed": self.last_refreshed[report_date.day]},
+                                "nextPageToken": next_page_token}]}
+
+    @patch("tap_google_analytics.sync.report_to_records", return_value=[])
+    def sync(self, state, *args, config=None, historically_syncing=False):
+        output = MagicMock()
+        output.write_records.return_value = 0
+        self.written_states = []
+        output.write_state.side_effect = lambda state: self.written_states.append(copy.deepcopy(state))
+        sync_report(self.client,
+                    {},
+                    self.report,
+                    utils.strptime_to_utc(state.get("bookmarks", {}).get("123", {}).get("12345", {}).get("last_report_date", "2019-11-01")),
+                    utils.strptime_to_utc("2019-11-03"),
+                    state,
+                    historically_syncing,
+                    output=output,
+                    config={"skip_unchanged_days": True} if config is None else config)
+        self.write_state_count = output.write_state.call_count
+        return output.write_records.call_count
+
+    def test_default_state_is_unchanged(self):
+        state = {}
+        self.sync(state, config={})
+
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-02'}}}}, state)
+        # One per bookmarked page, none for completing the days that aren't golden
+        self.assertEqual(3, self.write_state_count)
+
+    def test_data_last_refreshed_is_bookmarked(self):
+        state = {}
+        self.sync(state)
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-02',
+                                                          'data_last_refreshed': {'2019-11-02': '2019-11-03T00:00:00Z',
+                                                                                  '2019-11-03': '2019-11-03T00:00:00Z'}}}}},
+                         state)
+
+    def test_historical_sync_only_bookmarks_refreshed_days_with_a_report_date(self):
+        golden_days = {3}
+        self.client.get_report.side_effect = lambda name, profile_id, report_date, metrics, dimensions, page_token=None: iter(
+            [{"reports": [{"data": {"isDataGolden": report_date.day in golden_days,
+                                    "dataLastRefreshed": self.last_refreshed[report_date.day]}}]}])
+        state = {}
+        self.sync(state, historically_syncing=True)
+
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
+        for written_state in self.written_states:
+            self.assertIn('last_report_date', written_state['bookmarks']['123']['12345'])
+
+    def test_unchanged_days_are_skipped(self):
+        state = {}
+        self.sync(state)
+        self.requested_pages = []
+
+        self.assertEqual(0, self.sync(state))
+        self.assertEqual([2, 3], self.requested_pages)
+
+    def test_refreshed_days_are_synced(self):
+        state = {}
+        self.sync(state)
+        self.last_refreshed[3] = "2019-11-03T12:00:00Z"
+
+        self.assertEqual(2, self.sync(state))
+        self.assertEqual('2019-11-03T12:00:00Z',
+                         state['bookmarks']['123']['12345']['data_last_refreshed']['2019-11-03'])
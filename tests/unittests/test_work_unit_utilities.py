@@ -0,0 +1,108 @@
+import unittest
+from unittest.mock import MagicMock
+
+from tap_google_analytics import merge_work_unit_states, plan_work_units
+
+
+def make_unit_state(view_id, start_date, end_date, last_report_date=None, is_historical_sync=False, **outcome):
+    unit_state = {"work_unit": {"tap_stream_id": "report1",
+                                "view_id": view_id,
+                                "start_date": start_date,
+                                "end_date": end_date,
+                                "is_historical_sync": is_historical_sync,
+                                **outcome}}
+    if last_report_date:
+        unit_state["bookmarks"] = {"report1": {view_id: {"last_report_date": last_report_date}}}
+    return unit_state
+
+
+class TestPlanWorkUnits(unittest.TestCase):
+
+    def test_views_are_split_into_windows_from_their_bookmarks(self):
+        config = {"view_ids": ["12345", "67890"],
+                  "start_date": "2020-03-01",
+                  "end_date": "2020-03-10",
+                  "plan_window_days": 4}
+        state = {"bookmarks": {"report1": {"67890": {"last_report_date": "2020-03-08"}}}}
+        stream = MagicMock(tap_stream_id="report1", metadata=[])
+        catalog = MagicMock()
+        catalog.get_selected_streams.return_value = [stream]
+
+        units = plan_work_units(config, catalog, state)
+
+        self.assertEqual([("12345", "2020-03-01", "2020-03-04", True),
+                          ("12345", "2020-03-05", "2020-03-08", True),
+                          ("12345", "2020-03-09", "2020-03-10", True),
+                          ("67890", "2020-03-08", "2020-03-10", False)],
+                         [(u["view_id"], u["start_date"], u["end_date"], u["is_historical_sync"]) for u in units])
+        self.assertEqual([4, 4, 2, 3], [u["estimated_requests"] for u in units])
+        self.assertEqual("report1/12345/2020-03-05", units[1]["id"])
+
+
+class TestMergeWorkUnitStates(unittest.TestCase):
+
+    def test_golden_windows_advance_bookmark(self):
+        state = {"bookmarks": {"report1": {"12345": {"last_report_date": "2020-03-01"}}}}
+        unit_states = [make_unit_state("12345", "2020-03-05", "2020-03-08", "2020-03-06",
+                                       complete=True, all_data_golden=False, historically_syncing=False),
+                       make_unit_state("12345", "2020-03-01", "2020-03-04", "2020-03-04",
+                                       complete=True, all_data_golden=True, historically_syncing=False)]
+
+        actual = merge_work_unit_states(state, unit_states)
+
+        self.assertEqual({"bookmarks": {"report1": {"12345": {"last_report_date": "2020-03-06"}}},
+                          "currently_syncing": None},
+                         actual)
+
+    def test_incomplete_window_stops_bookmark(self):
+        unit_states = [make_unit_state("12345", "2020-03-01", "2020-03-04", "2020-03-02", is_historical_sync=True),
+                       make_unit_state("12345", "2020-03-05", "2020-03-08", "2020-03-08", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False)]
+
+        actual = merge_work_unit_states({}, unit_states)
+
+        self.assertEqual({"report1": {"12345": {"last_report_date": "2020-03-02"}}}, actual["bookmarks"])
+
+    def test_missing_window_stops_bookmark(self):
+        unit_states = [make_unit_state("12345", "2020-03-01", "2020-03-04", "2020-03-04", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False),
+                       make_unit_state("12345", "2020-03-09", "2020-03-10", "2020-03-10", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False)]
+
+        actual = merge_work_unit_states({}, unit_states)
+
+        self.assertEqual({"report1": {"12345": {"last_report_date": "2020-03-04"}}}, actual["bookmarks"])
+
+    def test_window_without_golden_data_passes_through_historical_sync(self):
+        unit_states = [make_unit_state("12345", "2020-03-01", "2020-03-04", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=True),
+                       make_unit_state("12345", "2020-03-05", "2020-03-08", "2020-03-08", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False)]
+
+        actual = merge_work_unit_states({}, unit_states)
+
+        self.assertEqual({"report1": {"12345": {"last_report_date": "2020-03-08"}}}, actual["bookmarks"])
+
+    def test_non_golden_window_start_after_historical_sync_stops_bookmark(self):
+        unit_states = [make_unit_state("12345", "2020-03-01", "2020-03-04", "2020-03-04", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False,
+                                       first_day_golden=False),
+                       make_unit_state("12345", "2020-03-05", "2020-03-08", "2020-03-08", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False,
+                                       first_day_golden=False)]
+
+        actual = merge_work_unit_states({}, unit_states)
+
+        self.assertEqual({"report1": {"12345": {"last_report_date": "2020-03-04"}}}, actual["bookmarks"])
+
+    def test_golden_window_start_after_historical_sync_advances_bookmark(self):
+        unit_states = [make_unit_state("12345", "2020-03-01", "2020-03-04", "2020-03-04", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False,
+                                       first_day_golden=False),
+                       make_unit_state("12345", "2020-03-05", "2020-03-08", "2020-03-08", is_historical_sync=True,
+                                       complete=True, all_data_golden=True, historically_syncing=False,
+                                       first_day_golden=True)]
+
+        actual = merge_work_unit_states({}, unit_states)
+
+        self.assertEqual({"report1": {"12345": {"last_report_date": "2020-03-08"}}}, actual["bookmarks"])